@@ -10,6 +10,7 @@ sys.path.append(bpy.path.abspath('//hwmtk\\'))
 import op_softblend
 # Import the main toolkit module
 import hwm
+import profiling
 
 class HwmOps_PreprocessHeadOp(bpy.types.Operator):
     """Preprocess abs correctors to rel correctors"""
@@ -20,7 +21,17 @@ class HwmOps_PreprocessHeadOp(bpy.types.Operator):
     def poll(cls, context):
         return bpy.context.mode == 'OBJECT'
     def execute(self, context):
+        # With a debug value set, print where the time went
+        # (and at 2 or more, save a trace to open in chrome://tracing)
+        profiling.Enable(hwm.util.IsDebugging())
+        profiling.Reset()
         relMesh = hwm.PreprocessMesh(absoluteMeshName)
+        if profiling.IsEnabled():
+            print (profiling.Report())
+            if hwm.util.DebugLevel() >= 2:
+                profiling.ExportChromeTrace(bpy.path.abspath('//hwm_trace.json'))
+                print ('Trace saved to', bpy.path.abspath('//hwm_trace.json'))
+            profiling.Enable(False)
         if (not relMesh):
             self.report({'WARNING'}, 'Failed to preprocess the %s mesh. Look in the console for now...' % absoluteMeshName)
         else:
@@ -0,0 +1,272 @@
+# Purpose: headless batch preprocessing
+# Runs hwm.PreprocessMesh over many .blend files, each in its own background Blender,
+# several at a time, and writes a JSON report of what happened.
+#
+# From a shell, with any Python 3:
+#   python batch.py --blender /path/to/blender -j 8 --report report.json a.blend b.blend
+#   python batch.py --blender /path/to/blender --manifest heads.json --save
+#
+# --mesh and --script apply to every file given on the command line. A manifest is
+# a JSON list of jobs (or {"jobs": [...]}), every job being
+#   {"blend": "a.blend", "mesh": "head_abs", "script": "//pre.py", "output": "a_rel.blend"}
+# where everything but "blend" is optional. Relative paths are relative to the manifest,
+# scripts starting with // to the .blend file. Jobs that fail don't stop the others,
+# the exit code is 1 if any failed.
+#
+# With --profile-script, the report of each job gets the hot lines of its script
+# (see profiling.ScriptProfiler). With --trace DIR, every job also writes its profiling spans
+# (see profiling.py) to DIR/<job number>_<blend name>_<mesh>.trace.json, in the Chrome trace format.
+#
+# Each Blender runs this same file again as its --python script (the worker side below),
+# which preprocesses one mesh and writes its result to a JSON file for the driver.
+
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+DEFAULT_MESH = 'head_abs'
+WORKER_FLAG = '--hwm-worker'
+
+# Printed lines starting with these end up in the report
+WARNING_PREFIXES = ('Warning', 'Error', 'Base shape', 'Invalid shape name', 'Ambiguous')
+
+
+# ====================================
+# Driver
+# ====================================
+
+def LoadManifest(path):
+    # Purpose: reads the job list of a manifest file, see the top of the file
+    with open(path) as f:
+        data = json.load(f)
+    jobs = data.get('jobs', []) if isinstance(data, dict) else data
+    base = os.path.dirname(os.path.abspath(path))
+    for job in jobs:
+        if 'blend' not in job:
+            raise ValueError('Manifest job without a "blend" file: %r' % job)
+        # Relative to the manifest, not to wherever the batch is started from
+        job['blend'] = os.path.join(base, job['blend'])
+        if job.get('output'):
+            job['output'] = os.path.join(base, job['output'])
+        if job.get('script') and not job['script'].startswith('//'):
+            job['script'] = os.path.join(base, job['script'])
+    return jobs
+
+def MakeJobs(blends, mesh = DEFAULT_MESH, script = None, save = False):
+    # Purpose: one job per .blend file, all with the same mesh and script
+    # save - write the result back into each file
+    jobs = []
+    for blend in blends:
+        job = {'blend': os.path.abspath(blend), 'mesh': mesh, 'script': script}
+        if save:
+            job['output'] = job['blend']
+        jobs.append(job)
+    return jobs
+
+def __Tail(text, lines = 20):
+    return '\n'.join(text.splitlines()[-lines:])
+
+def TraceName(index, job):
+    # Purpose: the file name of a job's trace, unique within a batch
+    # index - the job's position in the batch
+    blend = os.path.splitext(os.path.basename(job['blend']))[0]
+    mesh = re.sub(r'[^\w.-]', '_', job.get('mesh') or DEFAULT_MESH)
+    return '%03i_%s_%s.trace.json' % (index, blend, mesh)
+
+def RunJob(blender, job, threads = 1, timeout = None, force = False, trace = None, profile = False, index = 0):
+    # Purpose: preprocesses one job in a background Blender, blocks until it's done
+    # trace - a directory to write the job's Chrome trace to, see TraceName
+    # profile - profile the job's script per line
+    # index - the job's position in the batch
+    # Returns: the job's report entry
+    fd, resultPath = tempfile.mkstemp(suffix = '.json', prefix = 'hwm_')
+    os.close(fd)
+
+    args = dict(job)
+    args['mesh'] = args.get('mesh') or DEFAULT_MESH
+    args['threads'] = threads
+    args['force'] = force
+    args['result'] = resultPath
+    args['profile'] = profile
+    if trace:
+        args['trace'] = os.path.join(os.path.abspath(trace), TraceName(index, job))
+    command = [blender, '-b', job['blend'], '--python', os.path.abspath(__file__),
+               '--', WORKER_FLAG, json.dumps(args)]
+
+    entry = {'blend': job['blend'], 'mesh': args['mesh'], 'script': job.get('script'),
+             'ok': False, 'output': None, 'objects': [], 'warnings': [], 'errors': []}
+    startTime = time.time()
+    try:
+        proc = subprocess.run(command, stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
+                              timeout = timeout, universal_newlines = True)
+        entry['returncode'] = proc.returncode
+        log = proc.stdout
+        try:
+            with open(resultPath) as f:
+                entry.update(json.load(f))
+        except ValueError:
+            entry['errors'].append('Blender exited before reporting a result')
+        if proc.returncode != 0:
+            entry['ok'] = False
+            entry['errors'].append('Blender exited with code %i' % proc.returncode)
+        if not entry['ok']:
+            entry['log'] = __Tail(log)
+    except subprocess.TimeoutExpired:
+        entry['errors'].append('Timed out after %s seconds' % timeout)
+    except OSError as e:
+        entry['errors'].append('Could not start Blender: %s' % e)
+    finally:
+        os.remove(resultPath)
+    entry['seconds'] = round(time.time() - startTime, 3)
+    return entry
+
+def RunBatch(blender, jobs, processes = None, threads = 1, timeout = None, verbose = True, force = False,
+             trace = None, profile = False):
+    # Purpose: runs jobs on up to processes Blenders at once
+    # threads - workers for lattice.Execute inside every Blender
+    # force - full rebuilds, see hwm.PreprocessMesh
+    # trace - a directory for per job Chrome traces
+    # profile - profile the scripts per line
+    # Returns: the report, jobs in the order given
+    from concurrent.futures import ThreadPoolExecutor
+
+    processes = processes or os.cpu_count() or 1
+    startTime = time.time()
+    results = [None] * len(jobs)
+    # Threads only wait on the Blender processes, the work happens there
+    with ThreadPoolExecutor(max_workers = processes) as pool:
+        futures = dict((pool.submit(RunJob, blender, job, threads, timeout, force, trace, profile, i), i)
+                       for i, job in enumerate(jobs))
+        for future in futures:
+            i = futures[future]
+            results[i] = future.result()
+            if verbose:
+                print ('%s %s:%s (%.1f s)' % ('ok    ' if results[i]['ok'] else 'FAILED',
+                       results[i]['blend'], results[i]['mesh'], results[i]['seconds']))
+
+    return {'blender': blender,
+            'processes': processes,
+            'threads': threads,
+            'seconds': round(time.time() - startTime, 3),
+            'failed': sum(1 for r in results if not r['ok']),
+            'jobs': results}
+
+def Main(argv = None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Preprocess HWM heads in background Blenders.')
+    parser.add_argument('blends', nargs = '*', help = '.blend files to preprocess')
+    parser.add_argument('--manifest', help = 'JSON job list, see batch.py')
+    parser.add_argument('--blender', default = os.environ.get('BLENDER', 'blender'),
+                        help = 'Blender executable (default: $BLENDER or blender)')
+    parser.add_argument('--mesh', default = DEFAULT_MESH, help = 'absolute mesh name (default: %(default)s)')
+    parser.add_argument('--script', help = 'preprocess script for every file')
+    parser.add_argument('--save', action = 'store_true', help = 'save the results into the files')
+    parser.add_argument('-j', '--processes', type = int, default = None,
+                        help = 'Blenders at once (default: one per core)')
+    parser.add_argument('--threads', type = int, default = 1,
+                        help = 'corrector conversion threads per Blender (default: 1)')
+    parser.add_argument('--force', action = 'store_true',
+                        help = 'rebuild rel meshes from scratch instead of updating changed shapes')
+    parser.add_argument('--timeout', type = float, default = None, help = 'seconds per file')
+    parser.add_argument('--profile-script', action = 'store_true',
+                        help = 'report the slowest lines of the preprocess scripts')
+    parser.add_argument('--trace', help = 'write a Chrome trace of every job into this directory')
+    parser.add_argument('--report', help = 'write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    jobs = MakeJobs(args.blends, args.mesh, args.script, args.save)
+    if args.manifest:
+        jobs += LoadManifest(args.manifest)
+    if not jobs:
+        parser.error('no .blend files or manifest given')
+
+    if args.trace and not os.path.isdir(args.trace):
+        os.makedirs(args.trace)
+    report = RunBatch(args.blender, jobs, args.processes, args.threads, args.timeout,
+                      verbose = bool(args.report), force = args.force, trace = args.trace,
+                      profile = args.profile_script)
+    text = json.dumps(report, indent = 2)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(text)
+        print ('%i of %i failed, report written to %s' % (report['failed'], len(jobs), args.report))
+    else:
+        print (text)
+    return 1 if report['failed'] else 0
+
+
+# ====================================
+# Worker, inside Blender
+# ====================================
+
+class __Tee(object):
+    # Passes output through and keeps the lines worth reporting
+    def __init__(self, stream):
+        self.stream = stream
+        self.warnings = []
+        self.__line = ''
+
+    def write(self, text):
+        self.stream.write(text)
+        lines = (self.__line + text).split('\n')
+        self.__line = lines.pop()
+        self.warnings.extend(l.strip() for l in lines if l.strip().startswith(WARNING_PREFIXES))
+
+    def flush(self):
+        self.stream.flush()
+
+def RunWorker(args):
+    # Purpose: preprocesses args['mesh'] of the open .blend file and writes the result file
+    import traceback
+    import bpy
+
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import profiling
+    profiling.Enable(bool(args.get('trace')))
+
+    result = {'ok': False, 'output': None, 'objects': [], 'warnings': [], 'errors': []}
+    tee = __Tee(sys.stdout)
+    sys.stdout = tee
+    startTime = time.time()
+    try:
+        import hwm
+        before = set(bpy.data.objects.keys())
+        mesh_out = hwm.PreprocessMesh(args['mesh'], args.get('script'), workers = args.get('threads', 1),
+                                      force = args.get('force', False), profile = args.get('profile', False))
+        if args.get('profile') and hwm.scriptProfile:
+            result['scriptProfile'] = hwm.scriptProfile.Rows()
+        result['objects'] = sorted(set(bpy.data.objects.keys()) - before)
+        if mesh_out:
+            result['output'] = mesh_out.name
+            result['ok'] = True
+            if args.get('output'):
+                bpy.ops.wm.save_as_mainfile(filepath = args['output'])
+        else:
+            result['errors'].append('PreprocessMesh failed')
+    except Exception:
+        result['errors'].append(traceback.format_exc())
+    finally:
+        sys.stdout = tee.stream
+    result['preprocessSeconds'] = round(time.time() - startTime, 3)
+    if args.get('trace'):
+        try:
+            profiling.ExportChromeTrace(args['trace'])
+            result['trace'] = args['trace']
+        except OSError as e:
+            result['errors'].append('Could not write the trace: %s' % e)
+    result['warnings'] = tee.warnings
+
+    with open(args['result'], 'w') as f:
+        json.dump(result, f)
+
+
+if __name__ == '__main__':
+    if WORKER_FLAG in sys.argv:
+        RunWorker(json.loads(sys.argv[sys.argv.index(WORKER_FLAG) + 1]))
+    else:
+        sys.exit(Main())
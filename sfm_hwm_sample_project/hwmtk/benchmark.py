@@ -0,0 +1,267 @@
+# Purpose: preprocessing benchmarks on synthetic heads
+# Runs in plain Python on hwmcore models, no Blender needed:
+#   python benchmark.py --verts 20000 --bases 40 --correctors 80 --max-rank 4
+#   python benchmark.py --preset large --save-baseline my_machine.json
+#   python benchmark.py --preset large --baseline my_machine.json
+#
+# Every case is timed --repeat times (the best run counts) and run once more under
+# tracemalloc for its peak memory. With --baseline, cases slower than the baseline by
+# more than --tolerance (or using that much more memory) are flagged and the exit code is 1.
+# Baselines only mean something on the machine they were recorded on, keep them out of the repo.
+#
+# Cases:
+#   AbsToRel     - the conversion PreprocessMesh runs
+#   RelToAbs     - the conversion RebuildAbsoluteMesh runs
+#   SoftSelect   - BuildSoftSelection around a shape's region
+#   Grow         - GrowSelection by a few rings
+#   Select       - Select('add', ...) of a few shapes
+#   Script       - a representative preprocess script
+
+import json
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import numpy
+
+import hwmcore, selections
+
+PRESETS = {
+    'small'  : dict(verts = 5000,  bases = 20, correctors = 30,  max_rank = 3),
+    'medium' : dict(verts = 20000, bases = 40, correctors = 80,  max_rank = 4),
+    'large'  : dict(verts = 60000, bases = 60, correctors = 160, max_rank = 4),
+}
+
+DEFAULT_REPEAT = 5
+DEFAULT_TOLERANCE = 0.25
+
+
+# ====================================
+# Synthetic heads
+# ====================================
+
+def MakeHead(verts = 20000, bases = 40, correctors = 80, max_rank = 4, sparsity = 0.05, seed = 0):
+    # Purpose: a head-like hwmcore.FaceModel with absolute correctors
+    # verts - roughly how many vertices, laid out as a sphere grid
+    # bases - base (rank 1) shapes, each moving a round region of the head
+    # correctors - correctors spread over ranks 2 to max_rank, made of overlapping bases
+    # sparsity - the share of the head a base shape moves
+    rng = numpy.random.RandomState(seed)
+
+    rows = max(int(numpy.sqrt(verts / 2.0)), 3)
+    cols = max(verts // rows, 3)
+    theta = numpy.linspace(0.1, numpy.pi - 0.1, rows)
+    phi = numpy.linspace(0.0, 2 * numpy.pi, cols, endpoint = False)
+    t, p = numpy.meshgrid(theta, phi, indexing = 'ij')
+    basis = numpy.stack((numpy.sin(t) * numpy.cos(p), numpy.sin(t) * numpy.sin(p), numpy.cos(t)),
+                        axis = -1).reshape(-1, 3).astype(numpy.float32)
+    idx = numpy.arange(rows * cols).reshape(rows, cols)
+    edges = numpy.concatenate((
+        numpy.stack((idx[:, :].ravel(), numpy.roll(idx, -1, axis = 1).ravel()), axis = 1),
+        numpy.stack((idx[:-1, :].ravel(), idx[1:, :].ravel()), axis = 1))).astype(numpy.int32)
+    n = len(basis)
+
+    # Regions: the vertices closest to a random center, sparsity * n of them
+    size = max(int(sparsity * n), 1)
+    inRegion = numpy.zeros((bases, n), dtype = bool)
+    shapes = OrderedDict()
+    names = ['Ctrl%i' % i for i in range(bases)]
+    for i, name in enumerate(names):
+        center = basis[rng.randint(n)]
+        region = numpy.argsort(((basis - center) ** 2).sum(axis = 1))[:size]
+        inRegion[i, region] = True
+        delta = numpy.zeros((n, 3), dtype = numpy.float32)
+        delta[region] = rng.normal(0.0, 0.05, (size, 3))
+        shapes[name] = delta
+
+    # Correctors of overlapping bases, sculpted on top of the sum of their bases
+    for combo in __Combos(inRegion, correctors, max_rank, rng):
+        delta = numpy.sum([shapes[names[c]] for c in combo], axis = 0)
+        shared = numpy.nonzero(inRegion[list(combo)].all(axis = 0))[0]
+        if not len(shared):
+            shared = numpy.nonzero(inRegion[combo[0]])[0]
+        delta[shared] += rng.normal(0.0, 0.01, (len(shared), 3))
+        shapes['_'.join(names[c] for c in combo)] = delta.astype(numpy.float32)
+
+    return hwmcore.FaceModel(basis, shapes, edges)
+
+def __Combos(in_region, count, max_rank, rng):
+    # Purpose: count different base combinations of ranks 2 to max_rank
+    # Each one grows from a random base by random bases overlapping all picked so far,
+    # a combination that runs out of overlapping bases is filled up with any.
+    # Raises ValueError if there aren't count of them to be found
+    bases = len(in_region)
+    members = in_region.astype(numpy.float32)
+    overlaps = members.dot(members.T) > 0
+    maxRank = min(max_rank, bases)
+    if maxRank < 2:
+        raise ValueError('Correctors need at least 2 bases, there are %i' % bases)
+
+    combos = []
+    seen = set()
+    for attempt in range(count * 50):
+        if len(combos) == count:
+            break
+        rank = rng.randint(2, maxRank + 1)
+        combo = [rng.randint(bases)]
+        near = overlaps[combo[0]].copy()
+        near[combo[0]] = False
+        while len(combo) < rank:
+            pick = numpy.nonzero(near)[0]
+            if not len(pick):
+                pick = numpy.setdiff1d(numpy.arange(bases), combo)
+            combo.append(int(rng.choice(pick)))
+            near &= overlaps[combo[-1]]
+            near[combo] = False
+        combo = tuple(sorted(combo))
+        if combo not in seen:
+            seen.add(combo)
+            combos.append(combo)
+    if len(combos) < count:
+        raise ValueError('Found only %i different correctors of %i bases, asked for %i'
+                         % (len(combos), bases, count))
+    return combos
+
+def __Copy(model):
+    return hwmcore.FaceModel(model.basis, OrderedDict((k, v.copy()) for k, v in model.shapes.items()),
+                             model.Topology())
+
+
+# ====================================
+# Cases
+# ====================================
+
+def __Script(session, bases):
+    # Roughly what a preprocess script does per corrector
+    a, b = bases[0], bases[1]
+    session.Select(a)
+    session.GrowSelection(2)
+    session.SetState(a)
+    session.Interp(b, 0.5, 0.2, 'BELL')
+    session.Select(b)
+    session.Add(a, 0.5, 0.1, 'LINEAR')
+    session.Translate(0.0, 0.01, 0.0, 0.1)
+    session.SaveDelta(a + '_' + b)
+    session.ResetState()
+    session.ConvertAllToRelative()
+
+def Cases(model):
+    # Purpose: the benchmark cases of a model, as {name = (setup, run)}
+    # setup builds fresh inputs outside the timing, run(inputs) is what gets timed
+    bases = [name for name in model.shapes if '_' not in name]
+    plan = model.Plan()
+    seedSel = model.DisplacedSelection(bases[0])
+    topo = model.Topology()
+
+    def Converted():
+        rel = __Copy(model)
+        rel.AbsToRel(plan)
+        return rel
+
+    cases = OrderedDict()
+    cases['AbsToRel'] = (lambda: __Copy(model), lambda m: m.AbsToRel(plan))
+    cases['RelToAbs'] = (Converted, lambda m: m.RelToAbs(plan))
+    cases['SoftSelect'] = (lambda: seedSel,
+                           lambda s: selections.BuildSoftSelection(topo, s, 0.15, 'BELL', True))
+    cases['Grow'] = (lambda: seedSel, lambda s: selections.GrowRings(topo, s, 4))
+    cases['Select'] = (lambda: hwmcore.ScriptSession(model),
+                       lambda s: [s.Select('add', name) for name in bases[:8]])
+    cases['Script'] = (lambda: hwmcore.ScriptSession(__Copy(model)), lambda s: __Script(s, bases))
+    return cases
+
+def Measure(setup, run, repeat = DEFAULT_REPEAT):
+    # Purpose: the best time of repeat runs, and the peak memory of one more, traced
+    times = []
+    for i in range(repeat):
+        inputs = setup()
+        startTime = time.perf_counter()
+        run(inputs)
+        times.append(time.perf_counter() - startTime)
+
+    inputs = setup()
+    tracemalloc.start()
+    try:
+        run(inputs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(times), 'median': float(numpy.median(times)), 'peak_bytes': peak}
+
+def RunBenchmarks(head, repeat = DEFAULT_REPEAT, only = None, verbose = True):
+    # Purpose: runs every case on a synthetic head made with MakeHead(**head)
+    # only - case names to run, all by default
+    # Returns: the results, see Compare for the format
+    model = MakeHead(**head)
+    results = OrderedDict()
+    for name, (setup, run) in Cases(model).items():
+        if only and name not in only:
+            continue
+        results[name] = Measure(setup, run, repeat)
+        if verbose:
+            print ('%-12s %9.2f ms  %8.1f MB peak' % (name, results[name]['seconds'] * 1000,
+                                                      results[name]['peak_bytes'] / 1048576.0))
+    return {'head': head, 'vertices': model.n, 'shapes': len(model.shapes), 'cases': results}
+
+def Compare(report, baseline, tolerance = DEFAULT_TOLERANCE):
+    # Purpose: the cases of report that got slower or hungrier than in baseline
+    # Returns: a list of (case, what, baseline value, new value)
+    if baseline.get('head') != report['head']:
+        print ('Warning: the baseline was recorded on a different head:', baseline.get('head'))
+    regressions = []
+    for name, new in report['cases'].items():
+        old = baseline.get('cases', dict()).get(name)
+        if not old:
+            continue
+        for what in ('seconds', 'peak_bytes'):
+            if new[what] > old[what] * (1.0 + tolerance):
+                regressions.append((name, what, old[what], new[what]))
+    return regressions
+
+def Main(argv = None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Benchmark HWM preprocessing on synthetic heads.')
+    parser.add_argument('--preset', choices = sorted(PRESETS), default = 'medium')
+    parser.add_argument('--verts', type = int)
+    parser.add_argument('--bases', type = int)
+    parser.add_argument('--correctors', type = int)
+    parser.add_argument('--max-rank', type = int, choices = (2, 3, 4))
+    parser.add_argument('--sparsity', type = float, default = 0.05,
+                        help = 'share of the head a base shape moves (default: %(default)s)')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--repeat', type = int, default = DEFAULT_REPEAT)
+    parser.add_argument('--case', action = 'append', help = 'run only these cases')
+    parser.add_argument('--json', help = 'write the results here')
+    parser.add_argument('--baseline', help = 'compare against these results')
+    parser.add_argument('--save-baseline', help = 'write the results here as the new baseline')
+    parser.add_argument('--tolerance', type = float, default = DEFAULT_TOLERANCE,
+                        help = 'allowed slowdown, 0.25 = 25%% (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    head = dict(PRESETS[args.preset])
+    for key in ('verts', 'bases', 'correctors', 'max_rank'):
+        if getattr(args, key) is not None:
+            head[key] = getattr(args, key)
+    head['sparsity'] = args.sparsity
+    head['seed'] = args.seed
+
+    report = RunBenchmarks(head, args.repeat, args.case)
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent = 2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = Compare(report, json.load(f), args.tolerance)
+        for name, what, old, new in regressions:
+            print ('REGRESSION %s %s: %.4g -> %.4g (%+.0f%%)' % (name, what, old, new, (new / old - 1.0) * 100))
+        if regressions:
+            return 1
+        print ('No regressions')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(Main())
@@ -0,0 +1,806 @@
+# Purpose: reading and writing DMX files
+# A DMX file is a graph of elements. Every element has a class ('DmeCombinationOperator'...),
+# a name, a GUID and typed attributes in file order. Attributes of type element point to
+# other elements, which are written out inline where first seen and by GUID after that.
+#
+# Attribute values are plain Python values:
+#   element - Element or None      int, float, time - int, float, float (seconds)
+#   bool - bool                    string - str      binary - bytes
+#   color - 4 ints                 vector2, vector3, vector4, qangle, quaternion, matrix - floats
+# (tuples), and for the *_array types a list of those, except that arrays of the numeric
+# types are NumPy arrays, (count,) or (count, components), so big arrays stay cheap.
+#
+# Elements are indexed by GUID as they are read, references resolve through the index.
+# References to GUIDs defined later in the file (or never) get a stub element that is
+# filled in when the definition shows up.
+#
+# Files are keyvalues2 text or binary (version 5, see Binary below), Load tells them
+# apart by their header and Save writes either.
+#
+# Load(path, skip = ('controlValues', ...)) leaves the values of the attributes named in
+# skip unparsed: their text is only scanned for its end, parsed the first time the value
+# is used and written back verbatim if it never is.
+
+import mmap
+import re
+import struct
+import uuid
+from collections import OrderedDict
+
+import numpy
+
+# In the order of their binary type ids, starting at 1
+ATTRIBUTE_TYPES = ('element', 'int', 'float', 'bool', 'string', 'binary', 'time', 'color',
+                   'vector2', 'vector3', 'vector4', 'qangle', 'quaternion', 'matrix')
+ARRAY_SUFFIX = '_array'
+
+ENCODING_KEYVALUES2 = 'keyvalues2'
+
+# type = (components, array dtype) of the numeric types
+NUMERIC_TYPES = {
+    'int'        : (1, numpy.int32),
+    'float'      : (1, numpy.float32),
+    'bool'       : (1, numpy.bool_),
+    'time'       : (1, numpy.float64),
+    'color'      : (4, numpy.uint8),
+    'vector2'    : (2, numpy.float32),
+    'vector3'    : (3, numpy.float32),
+    'vector4'    : (4, numpy.float32),
+    'qangle'     : (3, numpy.float32),
+    'quaternion' : (4, numpy.float32),
+    'matrix'     : (16, numpy.float32),
+}
+
+__header = re.compile(r'\s*<!--\s*dmx\s+encoding\s+(\S+)\s+(\d+)\s+format\s+(\S+)\s+(\d+)\s*-->')
+# A quoted string or a bracket, after whitespace, commas and comments
+__token = re.compile(r'(?:\s|,|//[^\n]*|<!--.*?-->)*(?:"([^"\\]*(?:\\.[^"\\]*)*)"|([{}\[\]]))', re.S)
+__end = re.compile(r'(?:\s|//[^\n]*|<!--.*?-->)*\Z', re.S)
+__string = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"', re.S)
+# Everything up to the ] closing a value array
+__arrayBody = re.compile(r'(?:[^"\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*\]', re.S)
+# Just the strings and brackets, for skipping
+__structure = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]]', re.S)
+
+__unescapes = {'n': '\n', 't': '\t', 'v': '\v', 'b': '\b', 'r': '\r', 'f': '\f', 'a': '\a'}
+__escape = re.compile(r'\\(.)', re.S)
+
+
+def IsArrayType(attr_type):
+    return attr_type.endswith(ARRAY_SUFFIX)
+
+def ItemType(attr_type):
+    # Purpose: the type of the items of an array type, the type itself otherwise
+    return attr_type[:-len(ARRAY_SUFFIX)] if IsArrayType(attr_type) else attr_type
+
+def NewId():
+    return str(uuid.uuid4())
+
+
+class Element(object):
+    ''' type - the element class, like 'DmeCombinationOperator'. None for a stub
+        name, id - the element name and GUID string
+        attributes - OrderedDict attribute name = [attribute type, value],
+                     the name and the id aren't attributes
+        stub - only referenced so far, see the top of the file '''
+    def __init__(self, type_name, name = '', id = None):
+        self.type = type_name
+        self.name = name
+        self.id = id or NewId()
+        self.attributes = OrderedDict()
+        self.stub = type_name is None
+
+    def __getitem__(self, name):
+        attr = self.attributes[name]
+        if isinstance(attr[1], LazyValue):
+            attr[1] = attr[1].Resolve()
+        return attr[1]
+
+    def __setitem__(self, name, value):
+        # An existing attribute keeps its type, new ones need Set
+        self.attributes[name][1] = value
+
+    def __contains__(self, name):
+        return name in self.attributes
+
+    def __iter__(self):
+        return iter(self.attributes)
+
+    def __len__(self):
+        return len(self.attributes)
+
+    def get(self, name, default = None):
+        return self[name] if name in self.attributes else default
+
+    def Type(self, name):
+        # Purpose: the attribute type of the attribute name
+        return self.attributes[name][0]
+
+    def Set(self, name, attr_type, value):
+        # Purpose: adds or replaces an attribute
+        if ItemType(attr_type) not in ATTRIBUTE_TYPES:
+            raise ValueError('Unknown DMX attribute type %s' % attr_type)
+        self.attributes[name] = [attr_type, value]
+
+    def Remove(self, name):
+        del self.attributes[name]
+
+    def __repr__(self):
+        return '<%s "%s" %s>' % (self.type or 'stub', self.name, self.id)
+
+
+class LazyValue(object):
+    ''' The unparsed text of a skipped attribute value, see Element.__getitem__ '''
+    def __init__(self, reader, attr_type, start, end):
+        self.reader = reader
+        self.type = attr_type
+        self.start = start
+        self.end = end
+
+    def Text(self):
+        return self.reader.text[self.start:self.end]
+
+    def Resolve(self):
+        return ParseValueAt(self.reader, self.type, self.start)
+
+
+class Datamodel(object):
+    ''' A DMX file
+        root - the root element
+        formatName, formatVersion - what the file holds, 'model' 1 for studiomdl
+        index - {id = Element} of every element read or added '''
+    def __init__(self, format_name = 'model', format_version = 1):
+        self.root = None
+        self.formatName = format_name
+        self.formatVersion = format_version
+        self.index = dict()
+
+    def Find(self, id):
+        return self.index.get(id)
+
+    def NewElement(self, type_name, name = '', id = None):
+        # Purpose: a new element, registered in the index. Doesn't link it anywhere.
+        element = Element(type_name, name, id)
+        self.index[element.id] = element
+        return element
+
+    def Reference(self, id):
+        # Purpose: the element with this GUID, a stub if there's none yet
+        element = self.index.get(id)
+        if element is None:
+            element = self.index[id] = Element(None, id = id)
+        return element
+
+    def Elements(self):
+        # Purpose: every element reachable from the root, depth first, each once
+        # Skipped values that were never used aren't looked into
+        seen = set()
+        stack = [self.root] if self.root else []
+        while stack:
+            element = stack.pop()
+            if element.id in seen:
+                continue
+            seen.add(element.id)
+            yield element
+            for attrType, value in reversed(list(element.attributes.values())):
+                if isinstance(value, LazyValue):
+                    continue
+                if attrType == 'element' and value is not None:
+                    stack.append(value)
+                elif attrType == 'element_array':
+                    stack.extend(e for e in reversed(value) if e is not None)
+
+    def FindAll(self, type_name):
+        return [element for element in self.Elements() if element.type == type_name]
+
+
+# ====================================
+# Reading keyvalues2
+# ====================================
+
+class TextReader(object):
+    ''' Where parsing a keyvalues2 text is at '''
+    def __init__(self, dm, text, skip = ()):
+        self.dm = dm
+        self.text = text
+        self.pos = 0
+        self.skip = frozenset(skip)
+
+    def Error(self, msg, pos = None):
+        pos = self.pos if pos is None else pos
+        line = self.text.count('\n', 0, pos) + 1
+        return ValueError('DMX line %i: %s' % (line, msg))
+
+def __Unescape(s):
+    if '\\' not in s:
+        return s
+    return __escape.sub(lambda m: __unescapes.get(m.group(1), m.group(1)), s)
+
+def __Next(r):
+    # Returns: (string, None) or (None, bracket)
+    m = __token.match(r.text, r.pos)
+    if m is None:
+        raise r.Error('unexpected end of file' if __end.match(r.text, r.pos) else 'unexpected text')
+    r.pos = m.end()
+    return m.group(1), m.group(2)
+
+def __Expect(r, bracket):
+    s, b = __Next(r)
+    if b != bracket:
+        raise r.Error('expected %s' % bracket)
+
+def __NextString(r):
+    s, b = __Next(r)
+    if s is None:
+        raise r.Error('expected a string, got %s' % b)
+    return s
+
+def __Scalar(attr_type, s):
+    if attr_type == 'string':
+        return __Unescape(s)
+    if attr_type == 'float' or attr_type == 'time':
+        return float(s)
+    if attr_type == 'int':
+        return int(s)
+    if attr_type == 'bool':
+        return s.strip().lower() not in ('0', 'false', '')
+    if attr_type == 'binary':
+        return bytes.fromhex(''.join(s.split()))
+    if attr_type == 'color':
+        return tuple(int(x) for x in s.split())
+    return tuple(float(x) for x in s.split())
+
+def __Array(attr_type, items):
+    if attr_type in NUMERIC_TYPES:
+        components, dtype = NUMERIC_TYPES[attr_type]
+        text = ' '.join(items)
+        if attr_type == 'bool':
+            text = text.lower().replace('true', '1').replace('false', '0')
+        if numpy.issubdtype(dtype, numpy.floating):
+            values = numpy.array(text.split(), dtype = numpy.float64)
+        else:
+            values = numpy.array(text.split(), dtype = numpy.int64)
+        values = values.astype(dtype)
+        return values if components == 1 else values.reshape(-1, components)
+    return [__Scalar(attr_type, s) for s in items]
+
+def __SkipBlock(r):
+    # Purpose: moves past the bracket block starting at r.pos
+    # Returns: where the block's opening bracket is
+    depth = 0
+    start = None
+    for m in __structure.finditer(r.text, r.pos):
+        token = m.group()
+        if token in '{[':
+            if start is None:
+                start = m.start()
+            depth += 1
+        elif token in '}]':
+            depth -= 1
+            if depth == 0:
+                r.pos = m.end()
+                return start
+        elif start is None:
+            raise r.Error('expected a block', m.start())
+    raise r.Error('unclosed block')
+
+def __ReadValueArray(r, item_type):
+    __Expect(r, '[')
+    m = __arrayBody.match(r.text, r.pos)
+    if m is None:
+        raise r.Error('unclosed array')
+    body = r.text[r.pos:m.end() - 1]
+    r.pos = m.end()
+    if item_type in NUMERIC_TYPES:
+        # Numbers need no unquoting, just splitting
+        return __Array(item_type, [body.replace('"', ' ').replace(',', ' ')])
+    return __Array(item_type, __string.findall(body))
+
+def __ReadElementArray(r):
+    __Expect(r, '[')
+    elements = []
+    while True:
+        s, b = __Next(r)
+        if b == ']':
+            return elements
+        if s is None:
+            raise r.Error('expected an element')
+        s2, b2 = __Next(r)
+        if b2 == '{':
+            elements.append(__ReadElementBody(r, s))
+        elif s == 'element' and s2 is not None:
+            elements.append(r.dm.Reference(s2) if s2 else None)
+        else:
+            raise r.Error('expected an element')
+
+def __ReadElementBody(r, type_name):
+    # Reads an element after its {
+    element = Element(type_name)
+    while True:
+        name, b = __Next(r)
+        if b == '}':
+            break
+        if name is None:
+            raise r.Error('expected an attribute name')
+        attrType = __NextString(r)
+
+        if attrType == 'elementid' and name == 'id':
+            id = __NextString(r)
+            # A stub made by an earlier reference becomes this element
+            existing = r.dm.index.get(id)
+            if existing is not None and existing is not element:
+                if not existing.stub:
+                    raise r.Error('element %s defined twice' % id)
+                existing.attributes.update(element.attributes)
+                existing.name = element.name
+                element = existing
+            element.id = id
+            element.type = type_name
+            element.stub = False
+            r.dm.index[id] = element
+        elif attrType == 'string' and name == 'name':
+            element.name = __Unescape(__NextString(r))
+        elif attrType == 'element':
+            id = __NextString(r)
+            element.attributes[name] = [attrType, r.dm.Reference(id) if id else None]
+        elif name in r.skip and (IsArrayType(attrType) or attrType not in ATTRIBUTE_TYPES):
+            if attrType == 'element_array' or not IsArrayType(attrType):
+                start = __SkipBlock(r)
+            else:
+                # No nesting in value arrays, one match finds the end
+                __Expect(r, '[')
+                start = r.pos - 1
+                m = __arrayBody.match(r.text, r.pos)
+                if m is None:
+                    raise r.Error('unclosed array')
+                r.pos = m.end()
+            # An inline element's type is its class
+            element.attributes[name] = [attrType if IsArrayType(attrType) else 'element',
+                                        LazyValue(r, attrType, start, r.pos)]
+        elif attrType == 'element_array':
+            element.attributes[name] = [attrType, __ReadElementArray(r)]
+        elif IsArrayType(attrType):
+            element.attributes[name] = [attrType, __ReadValueArray(r, ItemType(attrType))]
+        elif attrType in ATTRIBUTE_TYPES:
+            element.attributes[name] = [attrType, __Scalar(attrType, __NextString(r))]
+        else:
+            # An inline element of class attrType
+            __Expect(r, '{')
+            element.attributes[name] = ['element', __ReadElementBody(r, attrType)]
+
+    if element.id not in r.dm.index:
+        # No "id" attribute
+        r.dm.index[element.id] = element
+    return element
+
+def ParseValueAt(r, attr_type, pos):
+    # Purpose: parses a skipped value, see LazyValue
+    # attr_type - the array type, or the class of an inline element
+    r.pos = pos
+    if attr_type == 'element_array':
+        return __ReadElementArray(r)
+    if IsArrayType(attr_type):
+        return __ReadValueArray(r, ItemType(attr_type))
+    __Expect(r, '{')
+    return __ReadElementBody(r, attr_type)
+
+def ParseKeyValues2(text, skip = ()):
+    # Purpose: reads a keyvalues2 DMX text
+    # skip - names of attributes to leave unparsed until used
+    # Returns: Datamodel
+    # Raises ValueError on malformed text
+    m = __header.match(text)
+    if m is None:
+        raise ValueError('Not a DMX file, the header is missing')
+    if m.group(1) != ENCODING_KEYVALUES2:
+        raise ValueError('Not a keyvalues2 DMX file: %s encoding' % m.group(1))
+    dm = Datamodel(m.group(3), int(m.group(4)))
+    r = TextReader(dm, text, skip)
+    r.pos = m.end()
+    while not __end.match(text, r.pos):
+        typeName = __NextString(r)
+        __Expect(r, '{')
+        element = __ReadElementBody(r, typeName)
+        if dm.root is None:
+            dm.root = element
+    if dm.root is None:
+        raise ValueError('Empty DMX file')
+    return dm
+
+
+# ====================================
+# Writing keyvalues2
+# ====================================
+
+def __Escape(s):
+    return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\t', '\\t')
+
+def __FormatScalar(attr_type, value):
+    if attr_type == 'string':
+        return __Escape(value)
+    if attr_type == 'float' or attr_type == 'time':
+        return '%.10g' % value
+    if attr_type == 'int':
+        return '%i' % value
+    if attr_type == 'bool':
+        return '1' if value else '0'
+    if attr_type == 'binary':
+        return bytes(value).hex().upper()
+    if attr_type == 'color':
+        return ' '.join('%i' % x for x in value)
+    return ' '.join('%.10g' % x for x in value)
+
+def __FormatArray(attr_type, values):
+    if attr_type in NUMERIC_TYPES:
+        components = NUMERIC_TYPES[attr_type][0]
+        values = numpy.asarray(values)
+        if attr_type == 'bool':
+            return ['1' if x else '0' for x in values.ravel().tolist()]
+        fmt = '%i' if attr_type in ('int', 'color') else '%.10g'
+        if components == 1:
+            return [fmt % x for x in values.ravel().tolist()]
+        fmt = ' '.join([fmt] * components)
+        return [fmt % tuple(row) for row in values.reshape(-1, components).tolist()]
+    return [__FormatScalar(attr_type, x) for x in values]
+
+def __WriteElement(element, depth, written):
+    # Yields: the text of an element from its class name on
+    tabs = '\t' * depth
+    written.add(element.id)
+    yield '%s"%s"\n%s{\n' % (tabs, element.type, tabs)
+    inner = tabs + '\t'
+    yield '%s"id" "elementid" "%s"\n' % (inner, element.id)
+    yield '%s"name" "string" "%s"\n' % (inner, __Escape(element.name))
+    for name, (attrType, value) in element.attributes.items():
+        if isinstance(value, LazyValue):
+            yield '%s"%s" "%s"\n%s%s\n' % (inner, name, value.type, inner, value.Text())
+        elif attrType == 'element':
+            if value is None:
+                yield '%s"%s" "element" ""\n' % (inner, name)
+            elif value.stub or value.id in written:
+                yield '%s"%s" "element" "%s"\n' % (inner, name, value.id)
+            else:
+                yield '%s"%s" "%s"\n' % (inner, name, value.type)
+                for text in __WriteElementBody(value, depth + 1, written):
+                    yield text
+        elif attrType == 'element_array':
+            yield '%s"%s" "element_array"\n%s[\n' % (inner, name, inner)
+            for i, item in enumerate(value):
+                last = '' if i == len(value) - 1 else ','
+                if item is None:
+                    yield '%s\t"element" ""%s\n' % (inner, last)
+                elif item.stub or item.id in written:
+                    yield '%s\t"element" "%s"%s\n' % (inner, item.id, last)
+                else:
+                    for text in __WriteElement(item, depth + 2, written):
+                        yield text
+                    yield last + '\n'
+            yield '%s]\n' % inner
+        elif IsArrayType(attrType):
+            items = __FormatArray(ItemType(attrType), value)
+            yield '%s"%s" "%s"\n%s[\n' % (inner, name, attrType, inner)
+            if items:
+                yield ',\n'.join('%s\t"%s"' % (inner, item) for item in items)
+                yield '\n'
+            yield '%s]\n' % inner
+        else:
+            yield '%s"%s" "%s" "%s"\n' % (inner, name, attrType, __FormatScalar(attrType, value))
+    yield '%s}' % tabs
+
+def __WriteElementBody(element, depth, written):
+    # An inline element attribute, the class name is written with the attribute name
+    texts = __WriteElement(element, depth, written)
+    next(texts)
+    tabs = '\t' * depth
+    yield '%s{\n' % tabs
+    for text in texts:
+        yield text
+    yield '\n'
+
+def IterKeyValues2(dm):
+    # Purpose: the keyvalues2 text of dm in pieces, for writing it out as it's made
+    yield '<!-- dmx encoding %s 1 format %s %i -->\n' % (ENCODING_KEYVALUES2, dm.formatName, dm.formatVersion)
+    for text in __WriteElement(dm.root, 0, set()):
+        yield text
+    yield '\n'
+
+def WriteKeyValues2(dm, f, chunk = 1 << 16):
+    # Purpose: writes dm to the text file f
+    pending = []
+    size = 0
+    for text in IterKeyValues2(dm):
+        pending.append(text)
+        size += len(text)
+        if size >= chunk:
+            f.write(''.join(pending))
+            pending = []
+            size = 0
+    f.write(''.join(pending))
+
+
+# ====================================
+# Binary
+# ====================================
+# Binary version 5, as studiomdl reads it (all little endian):
+#   header text line, '\0'
+#   string table: int32 count, then that many '\0' terminated strings
+#   int32 element count, then per element: int32 class string, int32 name string, 16 byte GUID
+#   per element: int32 attribute count, then per attribute: int32 name string, byte type, value
+# Type ids are ATTRIBUTE_TYPES positions + 1, arrays + ARRAY_TYPE_OFFSET. Arrays are an int32
+# count and their items back to back, so numeric ones are read and written as whole buffers.
+# Strings are table indices, except the items of string arrays which are inline.
+# Elements are list indices: -1 for None and -2 followed by a GUID string for an element
+# that isn't in the file. Times are int32 ticks of TIME_TICKS per second.
+
+ENCODING_BINARY = 'binary'
+BINARY_VERSION = 5
+ARRAY_TYPE_OFFSET = 14
+TIME_TICKS = 10000
+
+# type = (struct format, array dtype in the file) of the fixed size types
+__binaryFormats = {
+    'int'        : ('<i', '<i4'),
+    'float'      : ('<f', '<f4'),
+    'bool'       : ('<?', 'u1'),
+    'time'       : ('<i', '<i4'),
+    'color'      : ('<4B', 'u1'),
+    'vector2'    : ('<2f', '<f4'),
+    'vector3'    : ('<3f', '<f4'),
+    'vector4'    : ('<4f', '<f4'),
+    'qangle'     : ('<3f', '<f4'),
+    'quaternion' : ('<4f', '<f4'),
+    'matrix'     : ('<16f', '<f4'),
+}
+
+
+def TypeId(attr_type):
+    # Purpose: the binary type id of an attribute type
+    typeId = ATTRIBUTE_TYPES.index(ItemType(attr_type)) + 1
+    return typeId + ARRAY_TYPE_OFFSET if IsArrayType(attr_type) else typeId
+
+def TypeFromId(type_id):
+    if type_id > ARRAY_TYPE_OFFSET:
+        return ATTRIBUTE_TYPES[type_id - ARRAY_TYPE_OFFSET - 1] + ARRAY_SUFFIX
+    return ATTRIBUTE_TYPES[type_id - 1]
+
+
+class BinaryReader(object):
+    ''' Where reading a binary DMX buffer is at '''
+    def __init__(self, dm, buf, pos = 0):
+        self.dm = dm
+        self.buf = buf
+        self.pos = pos
+        self.strings = []
+        self.elements = []
+
+def __BUnpack(r, fmt):
+    values = struct.unpack_from(fmt, r.buf, r.pos)
+    r.pos += struct.calcsize(fmt)
+    return values
+
+def __BInt(r):
+    value = struct.unpack_from('<i', r.buf, r.pos)[0]
+    r.pos += 4
+    return value
+
+def __BString(r):
+    end = r.buf.find(b'\0', r.pos)
+    if end < 0:
+        raise ValueError('Binary DMX: unterminated string at %i' % r.pos)
+    s = bytes(r.buf[r.pos:end]).decode('utf-8')
+    r.pos = end + 1
+    return s
+
+def __BTableString(r):
+    return r.strings[__BInt(r)]
+
+def __BElement(r):
+    index = __BInt(r)
+    if index == -1:
+        return None
+    if index == -2:
+        return r.dm.Reference(__BString(r))
+    return r.elements[index]
+
+def __BScalar(r, attr_type):
+    if attr_type == 'element':
+        return __BElement(r)
+    if attr_type == 'string':
+        return __BTableString(r)
+    if attr_type == 'binary':
+        size = __BInt(r)
+        r.pos += size
+        return bytes(r.buf[r.pos - size:r.pos])
+    values = __BUnpack(r, __binaryFormats[attr_type][0])
+    if attr_type == 'time':
+        return values[0] / float(TIME_TICKS)
+    return values[0] if len(values) == 1 else values
+
+def __BArray(r, item_type):
+    count = __BInt(r)
+    if item_type == 'element':
+        return [__BElement(r) for i in range(count)]
+    if item_type == 'string':
+        return [__BString(r) for i in range(count)]
+    if item_type == 'binary':
+        return [__BScalar(r, 'binary') for i in range(count)]
+    components, dtype = NUMERIC_TYPES[item_type]
+    fileType = numpy.dtype(__binaryFormats[item_type][1])
+    # astype copies, so nothing keeps pointing into the buffer
+    values = numpy.frombuffer(r.buf, fileType, count * components, r.pos).astype(dtype)
+    r.pos += count * components * fileType.itemsize
+    if item_type == 'time':
+        values = values / float(TIME_TICKS)
+    return values if components == 1 else values.reshape(-1, components)
+
+def ReadBinary(buf):
+    # Purpose: reads a binary DMX file from a bytes-like buffer (bytes, mmap...)
+    # Returns: Datamodel. Nothing in it refers to buf.
+    # Raises ValueError on malformed data
+    end = buf.find(b'\0')
+    m = __header.match(bytes(buf[:max(end, 0)]).decode('ascii', 'replace'))
+    if m is None:
+        raise ValueError('Not a DMX file, the header is missing')
+    if m.group(1) != ENCODING_BINARY or int(m.group(2)) != BINARY_VERSION:
+        raise ValueError('Unsupported DMX encoding %s %s' % (m.group(1), m.group(2)))
+
+    dm = Datamodel(m.group(3), int(m.group(4)))
+    r = BinaryReader(dm, buf, end + 1)
+    try:
+        r.strings = [__BString(r) for i in range(__BInt(r))]
+        for i in range(__BInt(r)):
+            typeName = __BTableString(r)
+            name = __BTableString(r)
+            id = str(uuid.UUID(bytes_le = bytes(buf[r.pos:r.pos + 16])))
+            r.pos += 16
+            element = dm.Reference(id)
+            element.type = typeName
+            element.name = name
+            element.stub = False
+            r.elements.append(element)
+        for element in r.elements:
+            for i in range(__BInt(r)):
+                name = __BTableString(r)
+                attrType = TypeFromId(__BUnpack(r, '<B')[0])
+                if IsArrayType(attrType):
+                    element.attributes[name] = [attrType, __BArray(r, ItemType(attrType))]
+                else:
+                    element.attributes[name] = [attrType, __BScalar(r, attrType)]
+    except (struct.error, IndexError) as e:
+        raise ValueError('Binary DMX: corrupt or truncated at %i (%s)' % (r.pos, e))
+    if not r.elements:
+        raise ValueError('Empty DMX file')
+    dm.root = r.elements[0]
+    return dm
+
+
+def __BinaryElements(dm):
+    # Every element to write, the root first. Skipped values are parsed here,
+    # there's no binary form of their text.
+    elements = []
+    seen = set()
+    stack = [dm.root]
+    while stack:
+        element = stack.pop()
+        if element is None or element.stub or element.id in seen:
+            continue
+        seen.add(element.id)
+        elements.append(element)
+        for name in reversed(list(element.attributes)):
+            attrType = element.Type(name)
+            if attrType == 'element':
+                stack.append(element[name])
+            elif attrType == 'element_array':
+                stack.extend(reversed(element[name]))
+    return elements
+
+def __BStringTable(elements):
+    # string = index of every class, element name, attribute name and string value
+    table = OrderedDict()
+    for element in elements:
+        table.setdefault(element.type, len(table))
+        table.setdefault(element.name, len(table))
+        for name, (attrType, value) in element.attributes.items():
+            table.setdefault(name, len(table))
+            if attrType == 'string':
+                table.setdefault(value, len(table))
+    return table
+
+def __BPackElement(value, indices):
+    if value is None:
+        return struct.pack('<i', -1)
+    if value.id in indices:
+        return struct.pack('<i', indices[value.id])
+    return struct.pack('<i', -2) + value.id.encode('ascii') + b'\0'
+
+def __BPackValue(attr_type, value, table, indices):
+    if attr_type == 'element':
+        return __BPackElement(value, indices)
+    if attr_type == 'string':
+        return struct.pack('<i', table[value])
+    if attr_type == 'binary':
+        return struct.pack('<i', len(value)) + bytes(value)
+    if attr_type == 'time':
+        return struct.pack('<i', int(round(value * TIME_TICKS)))
+    fmt = __binaryFormats[attr_type][0]
+    return struct.pack(fmt, *value) if len(fmt) > 2 else struct.pack(fmt, value)
+
+def __BPackArray(item_type, values, indices):
+    head = struct.pack('<i', len(values))
+    if item_type == 'element':
+        return head + b''.join(__BPackElement(value, indices) for value in values)
+    if item_type == 'string':
+        return head + b''.join(value.encode('utf-8') + b'\0' for value in values)
+    if item_type == 'binary':
+        return head + b''.join(struct.pack('<i', len(value)) + bytes(value) for value in values)
+    values = numpy.asarray(values)
+    if item_type == 'time':
+        values = numpy.round(values * TIME_TICKS)
+    return head + numpy.ascontiguousarray(values, dtype = __binaryFormats[item_type][1]).tobytes()
+
+def IterBinary(dm):
+    # Purpose: the binary DMX form of dm in pieces, for writing it out as it's made
+    elements = __BinaryElements(dm)
+    table = __BStringTable(elements)
+    indices = dict((element.id, i) for i, element in enumerate(elements))
+
+    yield ('<!-- dmx encoding %s %i format %s %i -->\n' % (ENCODING_BINARY, BINARY_VERSION,
+           dm.formatName, dm.formatVersion)).encode('ascii') + b'\0'
+    yield struct.pack('<i', len(table))
+    yield b''.join(s.encode('utf-8') + b'\0' for s in table)
+    yield struct.pack('<i', len(elements))
+    for element in elements:
+        yield struct.pack('<ii', table[element.type], table[element.name]) + uuid.UUID(element.id).bytes_le
+    for element in elements:
+        yield struct.pack('<i', len(element.attributes))
+        for name in element.attributes:
+            attrType, value = element.Type(name), element[name]
+            yield struct.pack('<iB', table[name], TypeId(attrType))
+            if IsArrayType(attrType):
+                yield __BPackArray(ItemType(attrType), value, indices)
+            else:
+                yield __BPackValue(attrType, value, table, indices)
+
+def WriteBinary(dm, f):
+    # Purpose: writes dm to the binary file f
+    for data in IterBinary(dm):
+        f.write(data)
+
+
+# ====================================
+# Files
+# ====================================
+
+def Load(path, skip = ()):
+    # Purpose: reads a DMX file, text or binary
+    # skip - names of attributes to leave unparsed until used, see the top of the file.
+    #        Binary files are always read whole, arrays are single copies there.
+    # Returns: Datamodel
+    with open(path, 'rb') as f:
+        header = f.readline()
+        if ENCODING_BINARY.encode('ascii') not in header:
+            f.seek(0)
+            return ParseKeyValues2(f.read().decode('utf-8'), skip)
+        # Read straight from the page cache
+        buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            return ReadBinary(buf)
+        finally:
+            buf.close()
+
+def Save(dm, path, encoding = ENCODING_KEYVALUES2):
+    # Purpose: writes dm to path
+    # encoding - ENCODING_KEYVALUES2 or ENCODING_BINARY
+    if encoding == ENCODING_BINARY:
+        with open(path, 'wb') as f:
+            WriteBinary(dm, f)
+    elif encoding == ENCODING_KEYVALUES2:
+        with open(path, 'w', encoding = 'utf-8', newline = '\n') as f:
+            WriteKeyValues2(dm, f)
+    else:
+        raise ValueError('Unknown DMX encoding %s' % encoding)
+
+def Dumps(dm):
+    return ''.join(IterKeyValues2(dm))
+
+def DumpsBinary(dm):
+    return b''.join(IterBinary(dm))
@@ -1,68 +1,209 @@
 # ====================================
 # Face rules
 # ====================================
+# The DmeCombinationOperator of a face rules DMX (tf2_head_controllers.dmx and the like):
+# its controls, each driving one or more raw controls (shape controllers), the controls'
+# values and the domination rules. Read and written with dmx, as keyvalues2 text or binary.
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+import os
+
+import numpy
+
+import dmx
+
+# The project's face rules, what NewFaceRules(HWMDefaults = True) starts from
+HWM_DEFAULT_RULES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                 'tf2_head_controllers.dmx')
+
+# The row a new control starts with in each control values attribute: value, balance
+# and multilevel, as the controls of the project's rules have them. Only the lagged
+# values have balance and multilevel centered at 0.5.
+DEFAULT_CONTROL_VALUES = {
+    'controlValues'       : (0.0, 0.0, 0.0),
+    'controlValuesLagged' : (0.0, 0.5, 0.5),
+}
 
-import bpy, inspect
-
-'''
-
-def __ImportDatamodelPy():
-    import os, imp
-    appdata = os.getenv("APPDATA")
-    blender = os.path.join(appdata, "Blender Foundation\\Blender", str(bpy.app.version[0]) + '.' + str(bpy.app.version[1]))
-    dm_path = os.path.join(blender, "scripts\\addons\\io_scene_valvesource", "datamodel.py")
-    print (dm_path)
-    if os.path.exists(dm_path):
-        datamodel = imp.load_source("datamodel", dm_path)
-        return datamodel
-    else:
-        return None
-    
-datamodel = __ImportDatamodelPy()
-if (not datamodel):
-    raise ArgumentError('Datamodel.py not preset where it should be -- check your Blender Source Tools?')
-
-'''
-    
 dm_rules = None
 
+
+def __Path(dmxName):
+    # Paths starting with // are relative to the .blend file
+    return bpy.path.abspath(dmxName) if bpy else dmxName
+
+def __Rules():
+    if dm_rules == None:
+        raise ValueError('No face rules loaded. Load them with LoadFaceRules or NewFaceRules first')
+    return dm_rules
+
+def __Operator(dm):
+    operator = dm.root.get('combinationOperator')
+    if operator is None:
+        raise ValueError('The face rules have no combinationOperator')
+    return operator
+
 def __GetRawControl(dm, name):
-    pass
+    # Returns: (DmeCombinationInputControl, index in its rawControlNames) driving
+    #          the raw control name, or (None, None)
+    for control in __Operator(dm)['controls']:
+        rawNames = control['rawControlNames']
+        if name in rawNames:
+            return control, rawNames.index(name)
+    return None, None
 
 def __GetDmeCIC(dm, name):
-    pass
+    # Returns: the DmeCombinationInputControl called name, None if there's none
+    for control in __Operator(dm)['controls']:
+        if control.name == name:
+            return control
+    return None
 
-def __GetDmeDR(dm, name):
-    pass
+def __GetDmeDR(dm, dominators, suppressed):
+    # Returns: the DmeCombinationDominationRule with exactly these dominators and
+    #          suppressed controls, None if there's none
+    for rule in __Operator(dm)['dominators']:
+        if set(rule['dominators']) == set(dominators) and set(rule['suppressed']) == set(suppressed):
+            return rule
+    return None
+
+def __ControlValueAttributes(operator):
+    # The per-control vector3 arrays, one row for every control
+    return [name for name in ('controlValues', 'controlValuesLagged') if name in operator]
 
 def __Finalize():
+    global dm_rules
     dm_rules = None
-    mesh = None
 
 def UsePassthroughs():
-    ''' Purpose: '''    
+    ''' Purpose: '''
 
 def LoadFaceRules(dmxName):
-    pass
-    
-def SaveFaceRules(dmxName):
-    pass
-    
+    ''' Purpose: loads face rules to work on, text or binary DMX.
+        dmxName may be relative to the .blend file '''
+    global dm_rules
+    dm = dmx.Load(__Path(dmxName))
+    __Operator(dm)
+    dm_rules = dm
+    return dm
+
+def SaveFaceRules(dmxName, binary = False):
+    ''' Purpose: writes the face rules out, dmxName may be relative to the .blend file.
+        binary writes binary DMX, smaller and much faster to load; studiomdl reads both. '''
+    dmx.Save(__Rules(), __Path(dmxName), dmx.ENCODING_BINARY if binary else dmx.ENCODING_KEYVALUES2)
+
 def NewFaceRules(HWMDefaults = True):
-    pass
-  
+    ''' Purpose: starts new face rules, HWMDefaults starts from a copy of the project's
+        HWM_DEFAULT_RULES instead of an empty combination operator '''
+    global dm_rules
+    if HWMDefaults:
+        dm_rules = dmx.Load(HWM_DEFAULT_RULES)
+        return dm_rules
+
+    dm = dmx.Datamodel('model', 1)
+    dm.root = dm.NewElement('DmElement', 'root')
+    operator = dm.NewElement('DmeCombinationOperator', 'combinationOperator')
+    operator.Set('controls', 'element_array', [])
+    operator.Set('controlValues', 'vector3_array', numpy.zeros((0, 3), dtype = numpy.float32))
+    operator.Set('controlValuesLagged', 'vector3_array', numpy.zeros((0, 3), dtype = numpy.float32))
+    operator.Set('usesLaggedValues', 'bool', False)
+    operator.Set('dominators', 'element_array', [])
+    operator.Set('targets', 'element_array', [])
+    dm.root.Set('combinationOperator', 'element', operator)
+    dm_rules = dm
+    return dm
+
 def AddDominationRule(listDominators, listSuppressed):
-    pass
+    ''' Purpose: when all of listDominators are dialed in, listSuppressed are turned off.
+        Names are raw control names. A rule that's already there isn't added again. '''
+    dm = __Rules()
+    if __GetDmeDR(dm, listDominators, listSuppressed):
+        return
+    rule = dm.NewElement('DmeCombinationDominationRule', 'rule')
+    rule.Set('dominators', 'string_array', list(listDominators))
+    rule.Set('suppressed', 'string_array', list(listSuppressed))
+    __Operator(dm)['dominators'].append(rule)
 
 def ReorderControls(*controlNames):
-    ''' Reorders DmeCombinationInputControls by name '''
-    pass
+    ''' Reorders DmeCombinationInputControls by name: controlNames go first in the given order,
+        the rest keep their order after them '''
+    operator = __Operator(__Rules())
+    controls = operator['controls']
+    names = [control.name for control in controls]
+    for name in controlNames:
+        if name not in names:
+            raise ValueError('ReorderControls: no control %s' % name)
+    first = [names.index(name) for name in controlNames]
+    order = first + [i for i in range(len(controls)) if i not in first]
+    operator['controls'] = [controls[i] for i in order]
+    # The control values go along, for as many rows as there are
+    for attr in __ControlValueAttributes(operator):
+        values = operator[attr]
+        if len(values) >= len(controls):
+            operator[attr] = numpy.concatenate((values[order], values[len(controls):]))
 
 def GroupControls(groupName, *rawControlNames):
     ''' Creates a DmeCombinationInputControl groupName for rawControlNames'''
-    pass
-    
+    dm = __Rules()
+    operator = __Operator(dm)
+    if __GetDmeCIC(dm, groupName):
+        raise ValueError('GroupControls: there is a control %s already' % groupName)
+
+    stereo = False
+    scales = []
+    for rawName in rawControlNames:
+        control, index = __GetRawControl(dm, rawName)
+        scale = 0.0
+        if control is not None:
+            # Taken out of the control it was in
+            stereo = stereo or control['stereo']
+            # wrinkleScales may be shorter than rawControlNames, missing scales are 0.0
+            oldScales = control['wrinkleScales']
+            if index < len(oldScales):
+                scale = float(oldScales[index])
+            keep = [i for i in range(len(control['rawControlNames'])) if i != index]
+            control['rawControlNames'] = [control['rawControlNames'][i] for i in keep]
+            control['wrinkleScales'] = oldScales[[i for i in keep if i < len(oldScales)]]
+        scales.append(scale)
+
+    # Controls left without raw controls go, with their values. Like in ReorderControls,
+    # only attributes with a row for every control are kept in step, the rows of the
+    # others can't be told apart.
+    controls = operator['controls']
+    keep = [i for i, control in enumerate(controls) if control['rawControlNames']]
+    covering = [attr for attr in __ControlValueAttributes(operator) if len(operator[attr]) >= len(controls)]
+    for attr in covering:
+        values = operator[attr]
+        operator[attr] = numpy.concatenate((values[keep], values[len(controls):]))
+    controls = [controls[i] for i in keep]
+
+    group = dm.NewElement('DmeCombinationInputControl', groupName)
+    group.Set('rawControlNames', 'string_array', list(rawControlNames))
+    group.Set('stereo', 'bool', stereo)
+    group.Set('eyelid', 'bool', False)
+    group.Set('wrinkleScales', 'float_array', numpy.array(scales, dtype = numpy.float32))
+    operator['controls'] = controls + [group]
+    for attr in covering:
+        values = operator[attr]
+        row = numpy.array([DEFAULT_CONTROL_VALUES[attr]], dtype = numpy.float32)
+        operator[attr] = numpy.concatenate((values[:len(controls)], row, values[len(controls):]))
+    return group
+
 def SetWrinkleScale(controlName, rawControlName, scale):
-    pass
+    ''' Purpose: sets the wrinkle map scale of one raw control of a control '''
+    control = __GetDmeCIC(__Rules(), controlName)
+    if control is None:
+        raise ValueError('SetWrinkleScale: no control %s' % controlName)
+    rawNames = control['rawControlNames']
+    if rawControlName not in rawNames:
+        raise ValueError('SetWrinkleScale: control %s has no raw control %s' % (controlName, rawControlName))
+    scales = numpy.array(control['wrinkleScales'], dtype = numpy.float32)
+    if len(scales) < len(rawNames):
+        scales = numpy.concatenate((scales, numpy.zeros(len(rawNames) - len(scales), dtype = numpy.float32)))
+    scales[rawNames.index(rawControlName)] = scale
+    control['wrinkleScales'] = scales
 
-# ===========================s
\ No newline at end of file
+# ===========================
\ No newline at end of file
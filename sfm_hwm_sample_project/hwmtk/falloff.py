@@ -0,0 +1,114 @@
+# Purpose: soft selection falloff curves
+# Curves are functions of the distance to the hard selection divided by the falloff
+# distance (0 at the selection, 1 at the edge of the falloff) and are evaluated over
+# whole arrays of distances at once. Smooth curves can also go through a sampled
+# lookup table.
+#
+# RANDOM is seeded: with a seed the weight of a vertex only depends on the seed and
+# the vertex index, so preprocessing gives the same result every run.
+
+import numpy
+
+FALLOFF_TYPES = ('SPIKE', 'BELL', 'DOME', 'LINEAR', 'RANDOM')
+
+# For EnumProperty
+falloff_types_items = [(t, t, t) for t in FALLOFF_TYPES]
+
+DEFAULT_SEED = 0
+DEFAULT_LUT_SIZE = 1024
+
+# Distances at or below this get the full weight
+HARD_DISTANCE = 0.0001
+
+# (falloff_type, size) = LookupTable
+__tables = dict()
+
+
+def __Spike(l):
+    return 1 - numpy.sqrt(2 * l - l * l)
+
+def __Bell(l):
+    return (1 + 2 * l) * (1 - l) * (1 - l) # hermite h00
+
+def __Dome(l):
+    return numpy.sqrt(1 - l * l)
+
+def __Linear(l):
+    return 1 - l
+
+__curves = {
+    'SPIKE'  : __Spike,
+    'BELL'   : __Bell,
+    'DOME'   : __Dome,
+    'LINEAR' : __Linear,
+}
+
+
+def __Mix64(x):
+    # The splitmix64 finalizer, over uint64 arrays
+    x = (x ^ (x >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    return x ^ (x >> numpy.uint64(31))
+
+def RandomWeights(indices, seed = DEFAULT_SEED):
+    # Purpose: uniform [0, 1) weights, one per vertex index, reproducible for a seed
+    # A splitmix64 step: the golden gamma times (index + 1), offset by the mixed seed,
+    # through the finalizer. No generator state is involved, so the order vertices
+    # come in doesn't matter, and every seed is as good as any other.
+    with numpy.errstate(over = 'ignore'):
+        offset = __Mix64(numpy.array([seed & 0xFFFFFFFFFFFFFFFF], dtype = numpy.uint64))[0]
+        x = (numpy.asarray(indices, dtype = numpy.uint64) + numpy.uint64(1)) * numpy.uint64(0x9E3779B97F4A7C15)
+        x = __Mix64(x + offset)
+    return (x >> numpy.uint64(11)).astype(numpy.float64) / float(1 << 53)
+
+def Curve(l, falloff_type):
+    # Purpose: the exact curve over normalized distances l in [0, 1]
+    curve = __curves.get(falloff_type)
+    if curve is None:
+        raise ValueError('No curve for falloff type {}'.format(falloff_type))
+    return curve(numpy.clip(numpy.asarray(l, dtype = numpy.float64), 0.0, 1.0))
+
+
+class LookupTable(object):
+    ''' A falloff curve sampled at size + 1 evenly spaced points,
+        evaluated by linear interpolation '''
+    def __init__(self, falloff_type, size = DEFAULT_LUT_SIZE):
+        self.falloffType = falloff_type
+        self.size = size
+        self.xs = numpy.linspace(0.0, 1.0, size + 1)
+        self.ys = Curve(self.xs, falloff_type)
+
+    def Evaluate(self, l):
+        return numpy.interp(l, self.xs, self.ys)
+
+
+def GetLookupTable(falloff_type, size = DEFAULT_LUT_SIZE):
+    # Purpose: the cached lookup table of a curve, built on first use
+    table = __tables.get((falloff_type, size))
+    if table is None:
+        table = LookupTable(falloff_type, size)
+        __tables[(falloff_type, size)] = table
+    return table
+
+def Weights(distances, max_distance, falloff_type, seed = DEFAULT_SEED, indices = None, lut = False):
+    # Purpose: selection weights of an array of distances
+    # falloff_type - 'SPIKE', 'BELL', 'LINEAR', 'RANDOM', 'DOME'
+    # seed - seeds RANDOM, None draws from numpy's global generator like Blender's random would
+    # indices - the vertex index of every distance, RANDOM weights are tied to them,
+    #           defaults to the positions in the array
+    # lut - True or a LookupTable to interpolate the curve instead of evaluating it
+    # Returns: float32 array, 1.0 at the selection, 0.0 at max_distance and beyond
+    d = numpy.asarray(distances, dtype = numpy.float64)
+    if falloff_type == 'RANDOM':
+        if seed is None:
+            w = numpy.random.random(len(d))
+        else:
+            w = RandomWeights(numpy.arange(len(d)) if indices is None else indices, seed)
+    else:
+        l = numpy.clip(d / max_distance, 0.0, 1.0) if max_distance > 0.0 else numpy.ones(len(d))
+        if lut is True:
+            lut = GetLookupTable(falloff_type)
+        w = lut.Evaluate(l) if lut else Curve(l, falloff_type)
+    w[d <= HARD_DISTANCE] = 1.0
+    w[d >= max_distance] = 0.0
+    return w.astype(numpy.float32)
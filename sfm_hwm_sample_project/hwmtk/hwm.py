@@ -1,18 +1,28 @@
 import bpy, bmesh
-import obtools, shapescripting, shapetools, facerules, util
-import os
+import dmx, falloff, hwmcore, lattice, obtools, profiling, selections, shapebuffers, shapenames, shapescripting, shapetools, sparsedelta, topology, facerules, util
+import json, os
 
 from shapetools import *
 
 from bpy.props import * 
 
-from util import DebugPrint, GetMillisecs
+from util import DebugPrint
 
 if (util.IsDebugging()):
     import imp
     import op_softblend
+    imp.reload(falloff)
+    imp.reload(topology)
+    imp.reload(selections)
+    imp.reload(lattice)
+    imp.reload(hwmcore)
     imp.reload(obtools)
+    imp.reload(profiling)
+    imp.reload(shapebuffers)
+    imp.reload(shapenames)
     imp.reload(shapetools)
+    imp.reload(sparsedelta)
+    imp.reload(dmx)
     imp.reload(facerules)
     imp.reload(util)
     imp.reload(shapescripting)
@@ -31,6 +41,7 @@ ShapeInterfaceDict = {
     "SaveDelta"         :   shapescripting.SaveDelta,
     "Select"            :   shapescripting.Select,
     "SelectHalf"        :   shapescripting.SelectHalf,
+    "SetRandomSeed"     :   shapescripting.SetRandomSeed,
     "SetState"          :   shapescripting.SetState,
     "ShrinkSelection"   :   shapescripting.ShrinkSelection,
     "DeleteDelta"       :   shapescripting.DeleteDelta,
@@ -42,14 +53,38 @@ ShapeInterfaceDict = {
 }
 
 
-def PreprocessMesh(meshName, scriptFile = None):  
+# The profiling.ScriptProfiler of the last PreprocessMesh(..., profile = True) run
+scriptProfile = None
+
+# The rel mesh remembers what it was converted from in this custom property, 
+# see PreprocessHashes
+HASHES_PROPERTY = 'hwm_preprocess_hashes'
+
+
+@profiling.Profiled()
+def PreprocessMesh(meshName, scriptFile = None, workers = 1, backend = 'thread', 
+                   epsilon = sparsedelta.DEFAULT_EPSILON, force = False, profile = False):  
     # Purpose: preprocesses a HWM mesh by name either according to the specified script,
     # or just by converting every corrector to relative mode if no script is specified
     # There must be a '_raw' postfix in the mesh name.
     # A duplicate will be created.
+    # workers, backend - parallel corrector conversion, see lattice.Execute.
+    # The 'process' backend needs sys.executable to be a Python interpreter,
+    # in Blender builds where it isn't, point multiprocessing.set_executable() to one.
+    # epsilon - abs shape offsets this small count as zero, see sparsedelta.Compact
+    # force - without a script, an existing rel mesh is only updated where its abs shapes 
+    #         changed (see UpdateRelativeMesh), force = True rebuilds it from scratch.
+    #         Edits other than vertex positions, edges and shapes (UVs, materials...)
+    #         need a forced rebuild.
+    # Timed in profiling spans, see profiling.Enable
+    # profile - time every op the script calls per script line, the report is printed
+    #           after the run and the profiler kept in scriptProfile
     
+    global scriptProfile
     import traceback
     
+    scriptProfile = None
+    
     def Execute(script_path, var_dict):
         # Executes a script file
         if not os.path.exists(script_path):
@@ -65,25 +100,39 @@ def PreprocessMesh(meshName, scriptFile = None):
     
     print ("Preprocessing mesh %s" % meshName)
     
-    if (not mesh_in):
-        print ('Error: mesh %s not found!' % meshName)
-        return None
+    # The basis and the shapes may have been edited since the last run
+    shapebuffers.InvalidateBasis()
+    shapetools.InvalidateShapeIndex()
+    
+    with profiling.Span('Validate'):
+        if (not mesh_in):
+            print ('Error: mesh %s not found!' % meshName)
+            return None
         
-    if not (mesh_in.name.endswith('_abs')):
-        print ('Error: Please add "_abs" postfix to your absolute mesh name to avoid any confusion!')
-        return None
+        if not (mesh_in.name.endswith('_abs')):
+            print ('Error: Please add "_abs" postfix to your absolute mesh name to avoid any confusion!')
+            return None
     
-    if (not shapetools.HasShapes(mesh_in)):
-        print ('Error: mesh %s does not have any relative shape keys!' % mesh_in.name)
-        return None
+        if (not shapetools.HasShapes(mesh_in)):
+            print ('Error: mesh %s does not have any relative shape keys!' % mesh_in.name)
+            return None
     
-    if (not shapetools.ValidateShapeNames(mesh_in)):
-        print ('Error: mesh %s has a shape with an invalid name!' % mesh_in.name)
-        return None
+        if (not shapetools.ValidateShapeNames(mesh_in)):
+            print ('Error: mesh %s has a shape with an invalid name!' % mesh_in.name)
+            return None
+    
+        if (not shapetools.CheckForRedundantCorrectives(mesh_in)):
+            print ('Error: mesh %s has redundant corrective shapes!' % mesh_in.name)  
+            return None
     
-    if (not shapetools.CheckForRedundantCorrectives(mesh_in)):
-        print ('Error: mesh %s has redundant corrective shapes!' % mesh_in.name)  
-        return None 
+    hashes = None
+    if not scriptFile:
+        hashes = PreprocessHashes(mesh_in, epsilon)
+        mesh_rel = obtools.FindObject(mesh_in.name.replace('_abs', '_rel'))
+        if mesh_rel and not force:
+            dirty = FindDirtyShapes(mesh_rel, hashes)
+            if dirty is not None:
+                return UpdateRelativeMesh(mesh_in, mesh_rel, dirty, hashes, workers, backend)
     
     # Create the new mesh
     mesh_out = obtools.DuplicateObject(mesh_in.name, 
@@ -101,43 +150,48 @@ def PreprocessMesh(meshName, scriptFile = None):
             print("Invalid object specified!")
             return None
         print ('Executing', scriptFile)
+        interface = ShapeInterfaceDict
+        if profile:
+            scriptProfile = profiling.ScriptProfiler(bpy.path.abspath(scriptFile), shapescripting.Stats)
+            interface = scriptProfile.Wrap(ShapeInterfaceDict)
         failed = False
         try:
-            Execute(bpy.path.abspath(scriptFile), ShapeInterfaceDict)
+            with profiling.Span('Script', script = scriptFile):
+                Execute(bpy.path.abspath(scriptFile), interface)
         except:
             traceback.print_exc()
             failed = True
         finally:
+            if profile:
+                print (scriptProfile.Report())
             if failed:
                 print ('Script execution failed, restoring...')
                 obtools.DeleteObject(mesh_out.name)
                 return None
         shapescripting.Cleanup()  
-        return None    
     else:
-        maxRank = 1
+        selectors = []
         for shape in mesh_out.data.shape_keys.key_blocks:
             shape.value = 0.0
             if (shapescripting.SELECTOR_PREFIX in shape.name):
-                DebugPrint("Removing selector %s" % shape.name)
-                RemoveShapeKey(mesh_out, shape.name)
-            rank = GetShapeRank(shape.name)
-            if rank > maxRank:
-                maxRank = rank
-                
-        for i in range(2, maxRank + 1):
-            rankStartTime = GetMillisecs()
-            rankShapeCount = 0
-            for shape in mesh_out.data.shape_keys.key_blocks:
-                if GetShapeRank(shape.name) == i:
-                    rankShapeCount += 1
-                    if (not Corr_AbsToRel(mesh_out, mesh_out, shape, shape)):
-                        DebugPrint('Deleting mesh_out')
-                        obtools.DeleteObject(mesh_out.name)
-                        return None
-                    DebugPrint('Converted %s to relative' % shape.name, 2)
-            deltaTime = GetMillisecs() - rankStartTime
-            DebugPrint('Rank %i took %i msec, avg %i msec' % (i, deltaTime, deltaTime / rankShapeCount))       
+                selectors.append(shape.name)
+        DebugPrint("Removing selectors %s" % ', '.join(selectors))
+        RemoveShapeKeys(mesh_out, selectors)
+        
+        plan = PlanConversion(mesh_out)
+        if not plan:
+            DebugPrint('Deleting mesh_out')
+            obtools.DeleteObject(mesh_out.name)
+            return None
+        DebugPrint(plan.Describe(), 3)
+        
+        # All correctors are converted in one pass over the plan,
+        # lower ranks first, each shape read and written once
+        model = shapebuffers.LoadModel(mesh_out, plan.names)
+        converted = model.AbsToRel(plan, workers, backend, epsilon)
+        shapebuffers.StoreShapes(model, mesh_out, converted)
+        DebugPrint('Converted %s to relative' % ', '.join(converted), 2)
+        mesh_out[HASHES_PROPERTY] = json.dumps(hashes)
 
     for key in mesh_out.data.shape_keys.key_blocks:
         key.value = 0.0
@@ -147,24 +201,99 @@ def PreprocessMesh(meshName, scriptFile = None):
     return mesh_out
     
     
-def RebuildAbsoluteMesh(mesh_in):
+@profiling.Profiled()
+def PreprocessHashes(mesh_in, epsilon = sparsedelta.DEFAULT_EPSILON):
+    # Purpose: content hashes of everything a preprocessed mesh is made of:
+    # the connectivity, the basis and every abs shape but the selectors, in order
+    keys = mesh_in.data.shape_keys
+    shapes = [[shape.name, shapebuffers.HashShape(shape)] for shape in keys.key_blocks
+                if shape != keys.reference_key and shapescripting.SELECTOR_PREFIX not in shape.name]
+    return {'topology': topology.GetTopology(mesh_in, validate = True).hash,
+            'basis': shapebuffers.HashCoords(shapebuffers.GetBasisCoords(mesh_in)),
+            'epsilon': epsilon,
+            'shapes': shapes}
+
+def FindDirtyShapes(mesh_rel, hashes):
+    # Purpose: compares the hashes mesh_rel was made from to the current ones
+    # Returns: names of the shapes to convert again -- the changed ones and every corrector
+    #          with a changed sub-shape, or None if mesh_rel has to be rebuilt from scratch
+    try:
+        old = json.loads(mesh_rel[HASHES_PROPERTY])
+    except (KeyError, ValueError):
+        return None
+    
+    for item in ('topology', 'basis', 'epsilon'):
+        if old.get(item) != hashes[item]:
+            return None
+    oldNames = [name for name, _ in old.get('shapes', [])]
+    if oldNames != [name for name, _ in hashes['shapes']]:
+        # Shapes added, removed or reordered
+        return None
+    
+    changed = [shapenames.Parse(name).key for (name, h), (_, oldH) 
+                in zip(hashes['shapes'], old['shapes']) if h != oldH]
+    return set(name for name in oldNames
+                if any(key <= shapenames.Parse(name).key for key in changed))
+    
+@profiling.Profiled()
+def UpdateRelativeMesh(mesh_in, mesh_rel, dirty, hashes, workers = 1, backend = 'thread'):
+    # Purpose: converts the dirty shapes of mesh_in again, in place on mesh_rel
+    # The clean sub-shapes they need are read back from mesh_rel as they're relative already
+    if dirty:
+        print ('Updating %i changed shape(s) of %s' % (len(dirty), mesh_rel.name))
+    else:
+        print ('%s is up to date' % mesh_rel.name)
+    
+    if dirty:
+        plan = PlanConversion(mesh_in)
+        if not plan:
+            return None
+        needed = set(dirty)
+        for name in dirty:
+            needed.update(plan.Dependencies(name))
+        
+        # Clean shapes from mesh_rel, relative already, dirty ones from mesh_in
+        model = shapebuffers.LoadModel(mesh_rel, [name for name in needed if name not in dirty])
+        keys = mesh_in.data.shape_keys.key_blocks
+        for name in dirty:
+            model.SetDelta(name, shapebuffers.GetShapeDelta(mesh_in, keys[name]))
+        model.MakeRelative(dirty, lattice.BuildPlan(needed), workers, backend, hashes['epsilon'])
+        shapebuffers.StoreShapes(model, mesh_rel, dirty)
+    
+    mesh_rel[HASHES_PROPERTY] = json.dumps(hashes)
+    for key in mesh_rel.data.shape_keys.key_blocks:
+        key.value = 0.0
+    return mesh_rel
+    
+@profiling.Profiled()
+def PlanConversion(mesh):
+    # Purpose: builds the corrector dependency plan of a mesh, see lattice.ConversionPlan
+    # Returns None (and tells why) if the shapes can't be converted
+    try:
+        return lattice.BuildPlan(LatticeShapeNames(mesh))
+    except ValueError as e:
+        print ('Error: %s on mesh %s' % (e, mesh.name))
+        return None
+    
+    
+@profiling.Profiled()
+def RebuildAbsoluteMesh(mesh_in, workers = 1, backend = 'thread'):
     print ('\nRebuilding correctors mesh from', mesh_in.name)
+    shapebuffers.InvalidateBasis()
+    shapetools.InvalidateShapeIndex()
     mesh_out = obtools.DuplicateObject(mesh_in.name, mesh_in.name + '_absolute_correctors', False)
-    maxRank = 1
-    for shape in mesh_out.data.shape_keys.key_blocks:
-        rank = GetShapeRank(shape.name)
-        if rank > maxRank:
-            maxRank = rank
-    if maxRank == 1:
+    plan = PlanConversion(mesh_out)
+    if not plan:
+        return
+    if plan.MaxRank() < 2:
         print ('Nothing to convert here...')
         return
     
-    for i in reversed(range(2, maxRank)): 
-        print ('On to rank {} shapes...'.format(i))
-        for shape in mesh_out.data.shape_keys.key_blocks:
-            if GetShapeRank(shape.name) == i and IsCorrectorShapeName(shape.name):
-                Corr_RelToAbs(mesh_out, mesh_out, shape, shape)
-                print ('Converted', shape.name)
+    model = shapebuffers.LoadModel(mesh_out, plan.names)
+    converted = model.RelToAbs(plan, workers, backend)
+    shapebuffers.StoreShapes(model, mesh_out, converted)
+    for name in converted:
+        print ('Converted', name)
     print ('Done converting, created', mesh_out.name)
     
      
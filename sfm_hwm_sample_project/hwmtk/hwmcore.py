@@ -0,0 +1,423 @@
+# Purpose: the shape math without Blender
+# A FaceModel is a mesh reduced to NumPy arrays: the basis, the connectivity and one
+# delta per shape. Corrector conversion, selections and the preprocess script ops all
+# run on it, so the heavy work can happen in any Python process.
+# shapebuffers.LoadModel / StoreShapes move models in and out of Blender meshes.
+
+from collections import OrderedDict
+
+import numpy
+
+import falloff, lattice, profiling, selections, shapenames, sparsedelta, topology
+
+SELECTOR_PREFIX = 'SELECT-'
+
+# Select() picks the vertices a shape moves further than this (|dx| + |dy| + |dz|)
+DISPLACED_THRESHOLD = 0.001
+
+
+# ====================================
+# Array kernels
+# ====================================
+
+def InterpCoords(co_out, co_in, vtx_weight_dict, amount):
+    # Purpose: moves the weighted rows of the (n, 3) array co_out towards co_in, in place
+    # Works on coordinates and deltas alike
+    sel = selections.AsSelection(vtx_weight_dict)
+    idx, w = sel.indices, sel.weights
+    co_out[idx] += (co_in[idx] - co_out[idx]) * (amount * w)[:, None]
+    return co_out
+
+def AddCoords(co_out, delta_in, vtx_weight_dict, amount):
+    # Purpose: adds the weighted rows of delta_in to co_out, in place
+    sel = selections.AsSelection(vtx_weight_dict)
+    idx, w = sel.indices, sel.weights
+    co_out[idx] += delta_in[idx] * (amount * w)[:, None]
+    return co_out
+
+def TranslateCoords(co_out, vtx_weight_dict, dx, dy, dz):
+    # Purpose: translates the weighted rows of co_out, in place
+    sel = selections.AsSelection(vtx_weight_dict)
+    idx, w = sel.indices, sel.weights
+    co_out[idx] += w[:, None] * numpy.array((dx, dy, dz), dtype = numpy.float32)
+    return co_out
+
+
+# ====================================
+# Model
+# ====================================
+
+class FaceModel(object):
+    ''' basis - (n, 3) float32 rest positions
+        shapes - OrderedDict name = (n, 3) float32 delta against the basis,
+                 the basis (reference key) isn't one of them
+        edges - (m, 2) vertex index pairs, a ready topology.MeshTopology or a function
+                returning either, called on first use. Only selections growing along
+                the surface need them '''
+    def __init__(self, basis, shapes = None, edges = None):
+        self.basis = numpy.ascontiguousarray(basis, dtype = numpy.float32).reshape(-1, 3)
+        self.n = len(self.basis)
+        self.shapes = OrderedDict()
+        if isinstance(edges, topology.MeshTopology):
+            self.__topology = edges
+            self.__edges = None
+        else:
+            self.__topology = None
+            self.__edges = edges
+        self.__index = None
+        if shapes:
+            for name, delta in shapes.items():
+                self.SetDelta(name, delta)
+
+    def Topology(self):
+        # Purpose: the connectivity, built on first use
+        if self.__topology is None:
+            edges = self.__edges() if callable(self.__edges) else self.__edges
+            if isinstance(edges, topology.MeshTopology):
+                self.__topology = edges
+            else:
+                if edges is None:
+                    edges = numpy.zeros((0, 2), dtype = numpy.int32)
+                self.__topology = topology.MeshTopology(self.basis, edges)
+        return self.__topology
+
+    def Names(self):
+        return list(self.shapes.keys())
+
+    def LatticeNames(self):
+        # Purpose: names of the shapes taking part in abs/rel conversion (no selectors)
+        return [name for name in self.shapes if shapenames.IsValid(name)]
+
+    def Find(self, name, exact_mode = False):
+        # Purpose: the actual name of a shape, case-insensitive like shapetools.FindShapeKey
+        # Unless exact_mode, the order of controllers doesn't matter: A_B finds B_A
+        # Returns: None if there's no such shape
+        if self.__index is None:
+            byKey = dict()
+            byName = dict()
+            for shape in self.shapes:
+                lower = shape.lower()
+                byKey.setdefault(shapenames.Parse(lower).key, shape)
+                byName.setdefault(lower, shape)
+            self.__index = (byKey, byName)
+        name = name.lower()
+        if exact_mode:
+            return self.__index[1].get(name)
+        return self.__index[0].get(shapenames.Parse(name).key)
+
+    def Delta(self, name):
+        # Purpose: the delta of the shape Find finds for name
+        found = self.Find(name)
+        if found is None:
+            raise ValueError('Shape %s not found' % name)
+        return self.shapes[found]
+
+    def SetDelta(self, name, delta):
+        # Purpose: stores delta as the shape Find finds for name, or as a new shape called name
+        # float32 (n, 3) arrays are stored as they are, not copied
+        # Returns: the actual name
+        delta = numpy.ascontiguousarray(delta, dtype = numpy.float32).reshape(-1, 3)
+        if len(delta) != self.n:
+            raise ValueError('Shape %s has %i vertices, the model %i' % (name, len(delta), self.n))
+        found = self.Find(name)
+        if found is None:
+            found = name
+            self.__index = None
+        self.shapes[found] = delta
+        return found
+
+    def Remove(self, name):
+        # Returns: the actual name removed, None if there was no such shape
+        found = self.Find(name)
+        if found is not None:
+            del self.shapes[found]
+            self.__index = None
+        return found
+
+    def SubShapes(self, name):
+        # Purpose: actual names of the existing sub-shapes of name, lower ranks first
+        subs = []
+        for sub in shapenames.SubShapeNames(name):
+            found = self.Find(sub)
+            if found is not None:
+                subs.append(found)
+        return subs
+
+    def DisplacedSelection(self, name):
+        # Purpose: hard-selects every vertex the shape moves
+        displaced = numpy.nonzero(numpy.abs(self.Delta(name)).sum(axis = 1) > DISPLACED_THRESHOLD)[0]
+        return selections.Select(displaced, self.n)
+
+    def Plan(self, names = None):
+        # Purpose: the conversion plan of names, all lattice shapes by default
+        # Raises ValueError on ambiguous shapes or missing base shapes
+        return lattice.BuildPlan(self.LatticeNames() if names is None else names)
+
+    def MakeRelative(self, abs_names, plan = None, workers = 1, backend = 'thread',
+                     epsilon = sparsedelta.DEFAULT_EPSILON):
+        # Purpose: converts the absolute shapes abs_names to relative, in place
+        # Every other shape of the plan is taken as relative already
+        # plan, workers, backend, epsilon - see lattice.Execute
+        # Returns: names of the correctors that changed
+        return self.__Convert(set(abs_names), plan, True, workers, backend, epsilon)
+
+    def MakeAbsolute(self, rel_names, plan = None, workers = 1, backend = 'thread',
+                     epsilon = sparsedelta.DEFAULT_EPSILON):
+        # Purpose: converts the relative shapes rel_names to absolute, in place
+        # Every other shape of the plan is taken as absolute already
+        return self.__Convert(set(rel_names), plan, False, workers, backend, epsilon)
+
+    def AbsToRel(self, plan = None, workers = 1, backend = 'thread', epsilon = sparsedelta.DEFAULT_EPSILON):
+        # Purpose: converts every shape of the plan from absolute to relative
+        plan = plan or self.Plan()
+        return self.MakeRelative(plan.names, plan, workers, backend, epsilon)
+
+    def RelToAbs(self, plan = None, workers = 1, backend = 'thread', epsilon = sparsedelta.DEFAULT_EPSILON):
+        # Purpose: converts every shape of the plan from relative to absolute
+        plan = plan or self.Plan()
+        return self.MakeAbsolute(plan.names, plan, workers, backend, epsilon)
+
+    def __Convert(self, names, plan, to_rel, workers, backend, epsilon):
+        plan = plan or self.Plan()
+        given = dict((name, self.shapes[name]) for name in plan.names if name in names)
+        other = dict((name, self.shapes[name]) for name in plan.names if name not in names)
+        absDeltas, relDeltas = (given, other) if to_rel else (other, given)
+        changed = []
+        with profiling.Span('MakeRelative' if to_rel else 'MakeAbsolute', shapes = len(names), workers = workers):
+            for name, relDelta, absDelta in lattice.Execute(plan, absDeltas, relDeltas, workers, backend, epsilon):
+                # Base shapes read the same either way
+                if name in names and len(plan.names[name]) > 1:
+                    self.shapes[name] = sparsedelta.ToDense(relDelta if to_rel else absDelta)
+                    changed.append(name)
+        return changed
+
+
+# ====================================
+# Preprocess scripts
+# ====================================
+
+class ScriptSession(object):
+    ''' The state of a preprocess script working on a FaceModel, see shapescripting for the ops.
+        selection - the current selections.Selection
+        state - the work in progress, an (n, 3) delta against the basis
+        absolute - correctors still in absolute mode, all of them to begin with
+        overridden - correctors SaveDelta only converts, see OverrideCorrector
+        seed - seed of RANDOM falloffs
+        touched - how many vertices the ops have written so far, for profiling.ScriptProfiler '''
+    def __init__(self, model, absolute = None):
+        self.model = model
+        self.selection = selections.Selection(n = model.n)
+        self.state = numpy.zeros((model.n, 3), dtype = numpy.float32)
+        if absolute is None:
+            absolute = [name for name in model.shapes if shapenames.Parse(name).isCorrector]
+        self.absolute = set(absolute)
+        self.overridden = set()
+        self.seed = falloff.DEFAULT_SEED
+        self.touched = 0
+        # Shapes changed since the last TakeChanges
+        self.__written = set()
+        self.__removed = set()
+
+    def TakeChanges(self):
+        # Purpose: the shapes written and removed since the last call
+        # Returns: (written names, removed names)
+        written = [name for name in self.model.shapes if name in self.__written]
+        removed = sorted(self.__removed)
+        self.__written = set()
+        self.__removed = set()
+        return written, removed
+
+    def __Write(self, name, delta):
+        name = self.model.SetDelta(name, delta)
+        self.__written.add(name)
+        self.__removed.discard(name)
+        return name
+
+    def __Remove(self, name):
+        name = self.model.Remove(name)
+        self.__removed.add(name)
+        self.__written.discard(name)
+        self.absolute.discard(name)
+        self.overridden.discard(name)
+
+    def __FindFlex(self, name, exact_mode = False):
+        # Shapes first, then selectors
+        found = self.model.Find(name, exact_mode)
+        if found is None:
+            found = self.model.Find(SELECTOR_PREFIX + name)
+        return found
+
+    def __MakeRelative(self, names):
+        # Converts the absolute ones among names and their sub-shapes
+        targets = set()
+        for name in names:
+            for shape in self.model.SubShapes(name) + [name]:
+                if shape in self.absolute:
+                    targets.add(shape)
+        if not targets:
+            return
+        needed = set(targets)
+        for name in targets:
+            needed.update(self.model.SubShapes(name))
+        for name in self.model.MakeRelative(targets, self.model.Plan(needed)):
+            self.__written.add(name)
+            self.touched += self.model.n
+        self.absolute -= targets
+
+    def __Soften(self, falloff_distance, falloff_type):
+        if falloff_distance > 0.0:
+            self.selection = selections.BuildSoftSelection(self.model.Topology(), self.selection,
+                                                           falloff_distance, falloff_type, True, self.seed)
+
+    # Selections
+
+    def Select(self, arg, name = ''):
+        # Select('LowerLip') selects what LowerLip moves, Select('add', 'LowerLip') etc. combine
+        operation = arg.lower()
+        if operation in ('add', 'all', 'none', 'intersect', 'subtract'):
+            if self.model.Find(arg, True):
+                raise ValueError("It's forbidden to have shapes with names 'add', 'all', 'none', 'intersect', 'subtract'!")
+            if operation == 'all':
+                self.selection = selections.SelectAll(self.model.n)
+                return
+            if operation == 'none':
+                self.selection = selections.Selection(n = self.model.n)
+                return
+            flex = self.__FindFlex(name)
+            if flex is None:
+                raise ValueError('Select("{}") failed: not found.'.format(name))
+            secondarySel = self.model.DisplacedSelection(flex)
+            if operation == 'add':
+                self.selection = selections.SelectAdd(self.selection, secondarySel)
+            elif operation == 'intersect':
+                self.selection = selections.SelectIntersect(self.selection, secondarySel)
+            else:
+                self.selection = selections.SelectSubtract(self.selection, secondarySel)
+        else:
+            flex = self.__FindFlex(arg, True)
+            if flex is None:
+                raise ValueError('Select("{}") failed: not found.'.format(arg))
+            self.selection = self.model.DisplacedSelection(flex)
+
+    def SelectHalf(self, which):
+        x = self.model.basis[:, 0]
+        if which == 'LEFT' or (not isinstance(which, str) and which < 0.5):
+            half = numpy.nonzero(x >= 0.0)[0]
+        else:
+            half = numpy.nonzero(x <= 0.0)[0]
+        self.selection = selections.Select(half, self.model.n)
+
+    def GrowSelection(self, amount, falloff_type = None):
+        self.selection = selections.DiscardSoft(self.selection)
+        if int(amount) >= 1:
+            self.selection = selections.GrowRings(self.model.Topology(), self.selection,
+                                                  int(amount), falloff_type, self.seed)
+
+    def ShrinkSelection(self, amount, falloff_type = None):
+        self.selection = selections.DiscardSoft(self.selection)
+        if int(amount) >= 1:
+            self.selection = selections.ShrinkRings(self.model.Topology(), self.selection,
+                                                    int(amount), falloff_type, self.seed)
+
+    def SetRandomSeed(self, seed):
+        self.seed = int(seed)
+
+    # Editing the state
+
+    def Interp(self, towardsFlexName, weight = 1.0, falloff_distance = 0.0, falloff_type = 'BELL'):
+        towards = self.model.Find(towardsFlexName)
+        if towards is None:
+            raise ValueError('Interp({}) failed: flex not found!'.format(towardsFlexName))
+        if falloff_distance > 0.0:
+            self.selection = selections.DiscardSoft(self.selection)
+        self.__Soften(falloff_distance, falloff_type)
+        self.touched += len(self.selection)
+        InterpCoords(self.state, self.model.shapes[towards], self.selection, weight)
+
+    def Add(self, fromFlexName, weight = 1.0, falloff_distance = 0.0, falloff_type = 'BELL'):
+        self.__Soften(falloff_distance, falloff_type)
+        source = self.model.Find(fromFlexName)
+        if source is None:
+            raise ValueError('Add({}) failed: flex not found!'.format(fromFlexName))
+        self.touched += len(self.selection)
+        AddCoords(self.state, self.model.shapes[source], self.selection, weight)
+
+    def AddCorrected(self, fromFlexName, weight = 1.0, falloff_distance = 0.0, falloff_type = 'BELL'):
+        # Adds the shape with its correctors dialed in: its relative sub-shapes and itself
+        source = self.model.Find(fromFlexName)
+        if source is None:
+            raise ValueError('AddCorrected({}) failed: shape not found!'.format(fromFlexName))
+        self.__MakeRelative([source])
+        self.__Soften(falloff_distance, falloff_type)
+        self.touched += len(self.selection)
+        for name in self.model.SubShapes(source) + [source]:
+            AddCoords(self.state, self.model.shapes[name], self.selection, weight)
+        self.selection = selections.DiscardSoft(self.selection)
+
+    def Translate(self, dx, dy, dz, falloff_distance = 0.0, falloff_type = 'BELL'):
+        self.__Soften(falloff_distance, falloff_type)
+        self.touched += len(self.selection)
+        TranslateCoords(self.state, self.selection, dx, dy, dz)
+        self.selection = selections.DiscardSoft(self.selection)
+
+    def SetState(self, flexName):
+        flex = self.model.Find(flexName)
+        if flex is None:
+            raise ValueError('SetState({}) failed: flex not found!'.format(flexName))
+        self.state[:] = self.model.shapes[flex]
+        self.touched += self.model.n
+
+    def ResetState(self):
+        self.state.fill(0.0)
+        self.touched += self.model.n
+
+    # Shapes
+
+    def OverrideCorrector(self, shapeName):
+        # Protects this corrector from being overwritten by SaveDelta. Very useful if you
+        # aren't satisfied with the shape generated by the script and want to specify it
+        # explicitly without modifying the script.
+        shape = self.model.Find(shapeName)
+        if shape and shapenames.Parse(shape).isCorrector:
+            self.overridden.add(shape)
+
+    def SaveDelta(self, flexName):
+        # Saves the state as flexName, correctors are stored relative
+        existing = self.model.Find(flexName)
+        name = existing or flexName
+        # All sub-shapes must be relative
+        self.__MakeRelative(self.model.SubShapes(name))
+
+        if existing in self.overridden:
+            # Don't overwrite overridden correctors, only convert them to deltas
+            print ('Overridden', existing)
+            self.__MakeRelative([existing])
+            return
+
+        if existing:
+            print ('SaveDelta({}): shape replaced.'.format(flexName))
+        parsed = shapenames.Parse(name)
+        delta = self.state.copy()
+        for sub in self.model.SubShapes(name):
+            delta -= self.model.shapes[sub]
+        if parsed.isCorrector:
+            missing = [c for c in parsed.controllers if self.model.Find(c) is None]
+            if missing:
+                raise ValueError('SaveDelta({}) failed: base shape(s) {} not found'.format(flexName, ', '.join(missing)))
+        self.absolute.discard(self.__Write(name, delta))
+        self.touched += self.model.n
+
+    def DeleteDelta(self, name):
+        shape = self.__FindFlex(name)
+        if shape is None:
+            raise ValueError("DeleteDelta('{}') failed: not found.".format(name))
+        # Deleting a sub-shape of a relative corrector would break it
+        key = shapenames.Parse(shape).key
+        for other in self.model.shapes:
+            if key < shapenames.Parse(other).key and other not in self.absolute:
+                raise ValueError("DeleteDelta('{}') failed: {} is a sub-shape of {} which is already in relative mode. "
+                                 "You shouldn't delete sub-shapes of a relative corrector!".format(name, shape, other))
+        self.__Remove(shape)
+
+    def ConvertAllToRelative(self):
+        self.__MakeRelative(list(self.absolute))
@@ -0,0 +1,406 @@
+# Purpose: abs <-> rel corrector conversion on the subset lattice of controller sets
+#
+# A shape named A_B_C is keyed by its controller set {a, b, c}. When A, B and C are
+# dialed in, studiomdl sums up the relative shapes of every subset, so
+#
+#     Abs(S) = sum of Rel(T) over all non-empty subsets T of S
+#
+# Subsets that don't exist as shapes (A_C when only A_B_C was sculpted) have Rel(T) = 0,
+# missing base (rank 1) shapes are an error.
+#
+# Instead of summing 2^rank - 2 sub-shapes for every corrector, the whole face is pushed
+# through a Moebius/zeta transform one controller at a time over the downward closure of
+# all shapes. For S = (x1 < x2 < ... < xr) the partial sums
+#
+#     Stage(S, j) = sum of Rel(T) over T with S - {x1 .. xj} <= T <= S
+#
+# obey Stage(S, j) = Stage(S, j - 1) + Stage(S - xj, j - 1), with Stage(S, 0) = Rel(S)
+# and Stage(S, r) = Abs(S). Whichever end is known, every set costs rank additions,
+# and the stages of a rank can be dropped as soon as the next rank is done.
+# Stages are (n, 3) arrays. Shapes moving only a sliver of the head are taken in as
+# SparseDeltas (sparsedelta.Compact), and their stages stay sparse for as long as
+# that is cheaper.
+
+from collections import defaultdict
+from itertools import combinations
+
+import numpy
+
+import profiling, shapenames, sparsedelta
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8, no process backend
+    shared_memory = None
+
+
+def ControllerSet(name):
+    # Purpose: the lattice key of a shape name, a sorted tuple of lowercase controllers
+    return shapenames.Parse(name).canonical
+
+def Closure(keys):
+    # Purpose: the downward closure of keys -- every non-empty subset of every key
+    # Returns: dict {rank = set of controller sets}
+    byRank = defaultdict(set)
+    for key in keys:
+        for rank in range(1, len(key) + 1):
+            byRank[rank].update(combinations(key, rank))
+    return byRank
+
+def KeyShapes(names):
+    # Purpose: maps controller sets to shape names
+    # Raises ValueError if two shapes are driven by the same controllers
+    # or if a base shape needed by some corrector is missing
+    keyed = dict()
+    for name in names:
+        key = ControllerSet(name)
+        if key in keyed:
+            raise ValueError('Ambiguous shapes %s and %s' % (keyed[key], name))
+        keyed[key] = name
+
+    missing = [key[0] for key in Closure(keyed.keys())[1] if key not in keyed]
+    if missing:
+        raise ValueError('Base shape(s) %s not found' % ', '.join(sorted(missing)))
+    return keyed
+
+def __Sum(a, b):
+    # None stands for an all-zero delta
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return sparsedelta.Add(a, b)
+
+
+class PlanNode(object):
+    ''' One controller set of the lattice. name is None for subsets that aren't shapes
+        of their own but whose partial sums are still needed by their supersets. '''
+    def __init__(self, key, name):
+        self.key = key
+        self.name = name
+        self.rank = len(key)
+        
+    def Inputs(self):
+        # Purpose: the rank - 1 subsets whose stages this node consumes, in stage order
+        return [self.key[:i] + self.key[i + 1:] for i in range(self.rank)]
+    
+    def __repr__(self):
+        return 'PlanNode(%s, %s)' % ('_'.join(self.key), self.name)
+
+
+class ConversionPlan(object):
+    ''' The corrector dependency DAG of a set of shapes, in execution order.
+        Built once and reusable for any abs/rel mix of the same shapes. '''
+    def __init__(self, names):
+        self.keyed = KeyShapes(names)
+        self.names = dict((name, key) for key, name in self.keyed.items())
+        byRank = Closure(self.keyed.keys())
+        self.levels = []
+        for rank in sorted(byRank):
+            self.levels.append([PlanNode(key, self.keyed.get(key)) for key in sorted(byRank[rank])])
+            
+    def Nodes(self):
+        # Purpose: all nodes in topological order, lower ranks first
+        for level in self.levels:
+            for node in level:
+                yield node
+                
+    def MaxRank(self):
+        return len(self.levels)
+        
+    def Dependencies(self, name):
+        # Purpose: names of the existing sub-shapes the shape name depends on
+        key = self.names[name]
+        deps = []
+        for rank in range(1, len(key)):
+            for sub in combinations(key, rank):
+                if sub in self.keyed:
+                    deps.append(self.keyed[sub])
+        return deps
+        
+    def Describe(self):
+        # Purpose: a human-readable dump of the plan
+        lines = []
+        for rank, level in enumerate(self.levels, 1):
+            shapes = [node for node in level if node.name]
+            lines.append('Rank %i: %i shapes, %i virtual subsets' % 
+                            (rank, len(shapes), len(level) - len(shapes)))
+            if rank > 1:
+                for node in shapes:
+                    lines.append('    %s <- %s' % (node.name, ', '.join(self.Dependencies(node.name))))
+        return '\n'.join(lines)
+
+
+def BuildPlan(names):
+    # Purpose: plans the conversion of the shapes named names
+    # Raises ValueError on ambiguous shapes or missing base shapes
+    return ConversionPlan(names)
+
+def __NodeStages(rank, subs, data, from_abs):
+    # Purpose: the arithmetic of a single node, shared by all backends
+    # subs - the consumed stage of each input, None for zero
+    # data - the node's own abs or rel delta, None for virtual nodes
+    # Returns: the node's rank + 1 stages, or None if they are all zero
+    if data is None:
+        g = None
+    elif from_abs:
+        g = sparsedelta.SubtractAll(data, subs)
+    else:
+        g = data
+        
+    g = [g]
+    for i in range(rank):
+        g.append(__Sum(g[i], subs[i]))
+    if all(s is None for s in g):
+        return None
+    return g
+
+def __TimedNodeStages(node, subs, data, from_abs):
+    # Purpose: __NodeStages of a node in a profiling span, for the backends that run nodes in-process
+    if not profiling.enabled:
+        return __NodeStages(node.rank, subs, data, from_abs)
+    with profiling.Span('Node', shape = node.name, rank = node.rank):
+        return __NodeStages(node.rank, subs, data, from_abs)
+
+def __LevelInputs(level, prev, abs_deltas, rel_deltas, epsilon):
+    # Purpose: gathers what every node of a level needs, reading shape data
+    # Yields: (node, subs, data, from_abs)
+    for node in level:
+        subs = [prev[key] for key in node.Inputs()]
+        subs = [s[i] if s else None for i, s in enumerate(subs)]
+        
+        name = node.name
+        if name is None:
+            yield node, subs, None, False
+        elif name in abs_deltas:
+            yield node, subs, sparsedelta.Compact(abs_deltas[name], epsilon), True
+        elif name in rel_deltas:
+            yield node, subs, sparsedelta.Compact(rel_deltas[name], epsilon), False
+        else:
+            raise ValueError('No data for shape %s' % name)
+
+def __Results(node, g, data, from_abs):
+    # Yields: the (shape name, rel, abs) of a finished node, if it is a shape
+    if node.name is not None:
+        if from_abs:
+            yield node.name, g[0], data
+        else:
+            yield node.name, g[0], g[node.rank]
+
+
+def Execute(plan, abs_deltas, rel_deltas, workers = 1, backend = 'thread', 
+            epsilon = sparsedelta.DEFAULT_EPSILON):
+    # Purpose: converts a whole face between abs and rel correctors in one pass over plan
+    # abs_deltas - {shape name = delta} of shapes known in absolute form
+    # rel_deltas - {shape name = delta} of shapes known in relative form
+    # Deltas are (n, 3) arrays or SparseDeltas. Every shape of the plan must be in one 
+    # of them. Each one is read exactly once, so lazy mappings are fine.
+    # workers - > 1 converts the nodes of a level in parallel. The level's data is
+    #           snapshotted first, and the results come out in the same order and bit
+    #           for bit the same as with a single worker.
+    # backend - 'thread' (NumPy releases the GIL) or 'process' (shared memory, Python 3.8+)
+    # epsilon - input offsets this small are treated as zero, see sparsedelta.Compact
+    # Yields: (shape name, rel delta, abs delta) for every shape, in plan order. Deltas are
+    #         (n, 3) arrays or SparseDeltas, sparsedelta.ToDense takes either.
+    if workers > 1:
+        if backend == 'thread':
+            return __ExecuteThreaded(plan, abs_deltas, rel_deltas, epsilon, workers)
+        if backend == 'process':
+            return __ExecuteProcesses(plan, abs_deltas, rel_deltas, epsilon, workers)
+        raise ValueError('Unknown backend %s' % backend)
+    return __ExecuteSerial(plan, abs_deltas, rel_deltas, epsilon)
+
+def __ExecuteSerial(plan, abs_deltas, rel_deltas, epsilon):
+    prev = dict()
+    prev[()] = None
+    for rank, level in enumerate(plan.levels, 1):
+        # A level is finished before its results go out, so the span doesn't
+        # time whatever the caller does with them
+        stages = dict()
+        results = []
+        with profiling.Span('Rank %i' % rank, nodes = len(level)):
+            for node, subs, data, from_abs in __LevelInputs(level, prev, abs_deltas, rel_deltas, epsilon):
+                g = __TimedNodeStages(node, subs, data, from_abs)
+                stages[node.key] = g
+                results.extend(__Results(node, g, data, from_abs))
+        for result in results:
+            yield result
+        # Nothing past this level needs the stages of the previous one
+        prev = stages
+
+def __ExecuteThreaded(plan, abs_deltas, rel_deltas, epsilon, workers):
+    from concurrent.futures import ThreadPoolExecutor
+    
+    prev = dict()
+    prev[()] = None
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        for rank, level in enumerate(plan.levels, 1):
+            with profiling.Span('Rank %i' % rank, nodes = len(level), workers = workers):
+                # Shape data is read here, on the calling thread, never in the pool
+                inputs = list(__LevelInputs(level, prev, abs_deltas, rel_deltas, epsilon))
+                done = list(pool.map(lambda i: __TimedNodeStages(*i), inputs))
+            
+            stages = dict()
+            for (node, subs, data, from_abs), g in zip(inputs, done):
+                stages[node.key] = g
+                for result in __Results(node, g, data, from_abs):
+                    yield result
+            prev = stages
+
+
+def __PackArena(deltas):
+    # Purpose: packs deltas into one shared block, all indices first, then all offsets
+    # Dense deltas take n offset rows and leave their index rows unused
+    # Returns: (shared memory or None, spec to attach by, [(start, count, dense)] per delta)
+    slots = []
+    total = 0
+    for d in deltas:
+        dense = not sparsedelta.IsSparse(d)
+        count = len(d) if dense else len(d.indices)
+        slots.append((total, count, dense))
+        total += count
+    if total == 0:
+        return None, None, slots
+        
+    shm = shared_memory.SharedMemory(create = True, size = total * 16)
+    indices, offsets = __ArenaArrays(shm, total)
+    for d, (start, count, dense) in zip(deltas, slots):
+        if dense:
+            offsets[start:start + count] = d
+        else:
+            indices[start:start + count] = d.indices
+            offsets[start:start + count] = d.offsets
+    indices = offsets = None
+    return shm, (shm.name, total), slots
+
+def __ArenaArrays(shm, total):
+    indices = numpy.ndarray((total,), dtype = numpy.int32, buffer = shm.buf)
+    offsets = numpy.ndarray((total, 3), dtype = numpy.float32, buffer = shm.buf, offset = total * 4)
+    return indices, offsets
+
+def __FreeArena(shm):
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+def __ProcessJobs(n, spec, jobs):
+    # Purpose: runs in a worker process, converts the nodes in jobs out of a shared arena
+    # jobs - [(rank, arena slot of each consumed stage, arena slot of the data, from_abs)],
+    #        slots are (start, count, dense) or None for zero
+    # Returns: for every job its stages as copies, (indices, offsets) of sparse ones,
+    #          or None if all zero
+    shm = None
+    indices = offsets = None
+    if spec is not None:
+        shm = shared_memory.SharedMemory(name = spec[0])
+        indices, offsets = __ArenaArrays(shm, spec[1])
+        
+    def View(slot):
+        if slot is None:
+            return None
+        start, count, dense = slot
+        if dense:
+            return offsets[start:start + count]
+        return sparsedelta.SparseDelta(n, indices[start:start + count], offsets[start:start + count])
+    
+    try:
+        done = []
+        for rank, subSlots, dataSlot, from_abs in jobs:
+            g = __NodeStages(rank, [View(slot) for slot in subSlots], View(dataSlot), from_abs)
+            if g is None:
+                done.append(None)
+            else:
+                # Copies, the arena goes away on return
+                done.append([__StageCopy(s) for s in g])
+        return done
+    finally:
+        # Views must go before their block is closed
+        View = indices = offsets = g = None
+        if shm is not None:
+            shm.close()
+
+def __StageCopy(stage):
+    if stage is None:
+        return None
+    if sparsedelta.IsSparse(stage):
+        return stage.indices.copy(), stage.offsets.copy()
+    return stage.copy()
+
+def __ExecuteProcesses(plan, abs_deltas, rel_deltas, epsilon, workers):
+    # For every level the consumed stages and the level's own data are packed into
+    # a shared arena that all workers read from, the results come back pickled
+    from concurrent.futures import ProcessPoolExecutor
+    
+    if shared_memory is None:
+        raise ValueError('The process backend needs Python 3.8 or later')
+        
+    n = None
+    prev = dict()
+    prev[()] = None
+    shm = None
+    pool = ProcessPoolExecutor(max_workers = workers)
+    try:
+        for levelRank, level in enumerate(plan.levels, 1):
+            results = []
+            with profiling.Span('Rank %i' % levelRank, nodes = len(level), workers = workers):
+                inputs = list(__LevelInputs(level, prev, abs_deltas, rel_deltas, epsilon))
+            
+                packed = []
+                packedIds = dict()
+                def Slot(d):
+                    if d is None:
+                        return None
+                    if id(d) not in packedIds:
+                        packedIds[id(d)] = len(packed)
+                        packed.append(d)
+                    return packedIds[id(d)]
+                
+                jobs = []
+                for node, subs, data, from_abs in inputs:
+                    if n is None and data is not None:
+                        n = sparsedelta.VertexCount(data)
+                    jobs.append((node.rank, [Slot(d) for d in subs], Slot(data), from_abs))
+                
+                shm, spec, slots = __PackArena(packed)
+                packed = packedIds = None
+                jobs = [(rank, [slots[i] if i is not None else None for i in subSlots],
+                         slots[dataSlot] if dataSlot is not None else None, from_abs)
+                            for rank, subSlots, dataSlot, from_abs in jobs]
+            
+                chunk = (len(jobs) + workers - 1) // workers
+                futures = [pool.submit(__ProcessJobs, n, spec, jobs[i:i + chunk])
+                            for i in range(0, len(jobs), chunk)]
+                done = []
+                for future in futures:
+                    done.extend(future.result())
+                __FreeArena(shm)
+                shm = None
+            
+                stages = dict()
+                for (node, subs, data, from_abs), g in zip(inputs, done):
+                    if g is not None:
+                        g = [sparsedelta.SparseDelta(n, s[0], s[1]) if isinstance(s, tuple) else s for s in g]
+                    stages[node.key] = g
+                    results.extend(__Results(node, g, data, from_abs))
+            for result in results:
+                yield result
+            prev = stages
+    finally:
+        pool.shutdown()
+        __FreeArena(shm)
+
+def Transform(abs_deltas, rel_deltas):
+    # Purpose: plans and executes a conversion in one go, see Execute
+    plan = BuildPlan(list(abs_deltas.keys()) + list(rel_deltas.keys()))
+    return Execute(plan, abs_deltas, rel_deltas)
+
+def AbsToRel(abs_deltas):
+    # Purpose: converts every shape in abs_deltas to relative form
+    # Returns: {shape name = rel delta}, see Execute
+    return dict((name, rel) for name, rel, _ in Transform(abs_deltas, dict()))
+
+def RelToAbs(rel_deltas):
+    # Purpose: converts every shape in rel_deltas to absolute form
+    # Returns: {shape name = abs delta}, see Execute
+    return dict((name, abs) for name, _, abs in Transform(dict(), rel_deltas))
@@ -1,13 +1,10 @@
 import bpy
 
-import util
-from util import DebugPrint, GetMillisecs
+import profiling, util
+from util import DebugPrint
 
 def FindObject(Name):
-    for o in bpy.data.objects:
-        if o.name == Name:
-            return o
-    return None
+    return bpy.data.objects.get(Name)
 
 def DeleteObject(Name):
     # Courtesy of littleneo from blenderartists
@@ -56,8 +53,20 @@ def DeleteObject(Name):
             DebugPrint('Deleting %s' % Name)        
             wipeOutObject(o, True)
 
+def LinkLike(ob, like_ob):
+    # Purpose: links ob everywhere like_ob is linked, 
+    # its collections in 2.8+, its scenes before that
+    if hasattr(like_ob, 'users_collection'):
+        for coll in like_ob.users_collection:
+            coll.objects.link(ob)
+    else:
+        for sc in like_ob.users_scene:
+            sc.objects.link(ob)
+
+@profiling.Profiled()
 def DuplicateObject(fromName, toName, overwrite = True):  
-    
+    # Purpose: copies an object along with its mesh and shape keys
+    # Data API only: no operators, selection or scene changes, so it works in background mode
     
     if (fromName == toName): 
         print ('obtools.DuplicateObject: source and destination must differ...')
@@ -73,24 +82,12 @@ def DuplicateObject(fromName, toName, overwrite = True):
         if to_ob:
             DeleteObject(toName)
     
-    old_scene = bpy.context.scene
-    
-    bpy.context.screen.scene = from_ob.users_scene[0]
-    
-    for ob in bpy.data.objects:
-        ob.select = False
-        
-    from_ob.select = True
-    
-    bpy.context.scene.objects.active = from_ob    
-    bpy.ops.object.duplicate(linked=False, mode='TRANSLATION')
-    to_ob = bpy.context.scene.objects.active
+    to_ob = from_ob.copy()
+    if from_ob.data:
+        # Copying a mesh copies its shape keys too
+        to_ob.data = from_ob.data.copy()
     to_ob.name = toName
-    
-    from_ob.select = False  
-    to_ob.select = True
-     
-    bpy.context.screen.scene = old_scene
+    LinkLike(to_ob, from_ob)
      
     return to_ob
 
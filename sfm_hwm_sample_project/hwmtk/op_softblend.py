@@ -4,7 +4,7 @@ from bpy.props import *
 
 import hwm
 
-import shapetools, selections, obtools
+import falloff, shapebuffers, shapetools, selections, obtools
 from selections import *
 from shapetools import *
 
@@ -16,13 +16,6 @@ class ValveHWM_UL_ShapeKeys(bpy.types.UIList):
         row.label(item.name, icon = 'SHAPEKEY_DATA')
         
 
-falloff_types_items = [ ('SPIKE', 'SPIKE', 'SPIKE'),
-                        ('BELL', 'BELL', 'BELL'),
-                        ('DOME', 'DOME', 'DOME'),
-                        ('LINEAR', 'LINEAR', 'LINEAR'), 
-                        ('RANDOM', 'RANDOM', 'RANDOM')]
-                        
-
 class ValveHWM_SoftBlendFromShape(bpy.types.Operator):
     """This is Blend from Shape, but with Soft Selection!"""
     bl_idname = "mesh.softblendfromshape"
@@ -52,6 +45,11 @@ class ValveHWM_SoftBlendFromShape(bpy.types.Operator):
         description = "Will we use proportional selection?",
         default = True )    
     
+    prUseConnected = bpy.props.BoolProperty(
+        name = "Connected",
+        description = "Only soft-select vertices connected to the selection?",
+        default = True )
+    
     prFalloffDistance = bpy.props.FloatProperty(
         name = "Proportional distance", 
         description = "How fast the falloff would be?", 
@@ -64,9 +62,15 @@ class ValveHWM_SoftBlendFromShape(bpy.types.Operator):
     prFalloffType = bpy.props.EnumProperty(
         name = 'Falloff type',
         description = 'What falloff type to use?',
-        items = falloff_types_items,
+        items = falloff.falloff_types_items,
         default = 'BELL')
     
+    prSeed = IntProperty(
+        name = "Seed",
+        description = "Seed of the RANDOM falloff",
+        default = falloff.DEFAULT_SEED,
+        min = 0)
+    
     @classmethod
     def poll(cls, context):
         o = context.active_object
@@ -101,9 +105,11 @@ class ValveHWM_SoftBlendFromShape(bpy.types.Operator):
         if self.prUseSoft: 
             weights = BuildSoftSelection(bmesh_in = bm, 
                 vtx_weight_dict = weights, falloff_distance = self.prFalloffDistance, 
-                falloff_type = self.prFalloffType)
+                falloff_type = self.prFalloffType, use_connected = self.prUseConnected,
+                seed = self.prSeed)
         
         bpy.ops.object.mode_set(mode='OBJECT') 
+        shapebuffers.InvalidateBasis(o)
                         
         if self.prAdd:
             Add(o, weights, fromKey, toKey, self.prAmount)
@@ -133,9 +139,12 @@ class ValveHWM_SoftBlendFromShape(bpy.types.Operator):
         r = l.row()
         if (self.prUseSoft):
             r.prop(self, "prFalloffDistance")
+            r.prop(self, "prUseConnected")
             r = l.row()
             r.prop_menu_enum(self, "prFalloffType")
             r.label(self.prFalloffType)
+            if self.prFalloffType == 'RANDOM':
+                r.prop(self, "prSeed")
 			
 def register(): 
     # Soft Blend from Shape
@@ -0,0 +1,261 @@
+# Purpose: timing spans
+# Code to be timed goes in a named span, spans nest:
+#
+#     with profiling.Span('StoreShapes', shapes = len(names)):
+#         ...
+#
+#     @profiling.Profiled()
+#     def LoadModel(mesh, names = None):
+#
+# Profiling is off until Enable() is called. While off, Span() hands out one shared
+# do-nothing span and Profiled functions are called straight through, so spans can
+# stay in the hot paths.
+#
+# Recorded spans can be summed up per name (Totals, Report) or exported as JSON or as
+# a Chrome trace (ExportChromeTrace, open it in chrome://tracing or ui.perfetto.dev).
+# Spans opened on worker threads keep their own nesting and show up as their own
+# tracks. Worker processes aren't recorded.
+#
+# ScriptProfiler times the ops a preprocess script calls, per line of the script.
+
+import functools
+import json
+import linecache
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+enabled = False
+
+# Finished spans: [name, start, duration, child time, depth, thread id, args]
+__spans = []
+__epoch = time.perf_counter()
+__local = threading.local()
+
+
+class __NullSpan(object):
+    ''' The span handed out while profiling is off '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def Set(self, **args):
+        pass
+
+__nullSpan = __NullSpan()
+
+
+def __Stack():
+    stack = getattr(__local, 'stack', None)
+    if stack is None:
+        stack = __local.stack = []
+    return stack
+
+def __Record(span):
+    __spans.append([span.name, span.start - __epoch, span.duration, span.children,
+                    span.depth, span.thread, span.args])
+
+class __TimedSpan(object):
+    ''' A span being timed, see Span '''
+    def __init__(self, name, args, stack, record):
+        self.name = name
+        self.args = args
+        self.stack = stack
+        self.record = record
+
+    def __enter__(self):
+        self.depth = len(self.stack)
+        self.thread = threading.current_thread().ident
+        self.children = 0.0
+        self.stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.duration = time.perf_counter() - self.start
+        self.stack.pop()
+        if self.stack:
+            self.stack[-1].children += self.duration
+        self.record(self)
+        return False
+
+    def Set(self, **args):
+        # Purpose: adds arguments known only once the span is running
+        self.args.update(args)
+
+
+def Enable(on = True):
+    # Purpose: switches profiling on or off, recorded spans are kept
+    global enabled
+    enabled = bool(on)
+
+def IsEnabled():
+    return enabled
+
+def Reset():
+    # Purpose: drops every recorded span, trace times start over from now
+    global __epoch
+    del __spans[:]
+    __epoch = time.perf_counter()
+
+def Span(name, **args):
+    # Purpose: a context manager timing its body as a span called name
+    # args - anything worth seeing with the span, like a shape name or a vertex count.
+    #        JSON-able values only. More can be added from inside with span.Set(...)
+    if not enabled:
+        return __nullSpan
+    return __TimedSpan(name, args, __Stack(), __Record)
+
+def Profiled(name = None):
+    # Purpose: a decorator timing every call of a function as a span
+    # name - the span name, the function's name by default
+    def Decorate(func):
+        spanName = name or func.__name__
+
+        @functools.wraps(func)
+        def Wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with __TimedSpan(spanName, dict(), __Stack(), __Record):
+                return func(*args, **kwargs)
+        return Wrapper
+    return Decorate
+
+
+# ====================================
+# Results
+# ====================================
+
+def Spans():
+    # Purpose: the recorded spans in the order they finished, as dicts
+    # Times are in seconds, start since Reset
+    return [{'name': name, 'start': start, 'duration': duration, 'self': duration - children,
+             'depth': depth, 'thread': thread, 'args': args}
+                for name, start, duration, children, depth, thread, args in list(__spans)]
+
+def Totals():
+    # Purpose: the recorded spans summed up per name
+    # Returns: OrderedDict name = {'count', 'total', 'self', 'min', 'max'}, seconds,
+    #          by total time, longest first. 'self' is the time not spent in nested spans.
+    totals = dict()
+    for name, start, duration, children, depth, thread, args in list(__spans):
+        t = totals.get(name)
+        if t is None:
+            t = totals[name] = {'count': 0, 'total': 0.0, 'self': 0.0, 'min': duration, 'max': duration}
+        t['count'] += 1
+        t['total'] += duration
+        t['self'] += duration - children
+        t['min'] = min(t['min'], duration)
+        t['max'] = max(t['max'], duration)
+    return OrderedDict(sorted(totals.items(), key = lambda item: -item[1]['total']))
+
+def Report(limit = None):
+    # Purpose: the per-name totals as a printable table
+    lines = ['%-32s %7s %11s %11s %11s' % ('span', 'calls', 'total ms', 'self ms', 'max ms')]
+    for name, t in list(Totals().items())[:limit]:
+        lines.append('%-32s %7i %11.2f %11.2f %11.2f' % (name, t['count'], t['total'] * 1000,
+                                                         t['self'] * 1000, t['max'] * 1000))
+    return '\n'.join(lines)
+
+def ExportJSON(path):
+    # Purpose: writes the spans and their totals to path
+    with open(path, 'w') as f:
+        json.dump({'totals': Totals(), 'spans': Spans()}, f, indent = 1)
+
+def ExportChromeTrace(path):
+    # Purpose: writes the spans to path in the Chrome trace event format
+    pid = os.getpid()
+    events = []
+    for name, start, duration, children, depth, thread, args in list(__spans):
+        events.append({'name': name, 'cat': 'hwm', 'ph': 'X', 'pid': pid, 'tid': thread,
+                       'ts': start * 1e6, 'dur': duration * 1e6, 'args': args})
+    # Outer spans first where they start together, so viewers nest them right
+    events.sort(key = lambda e: (e['ts'], -e['dur']))
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+# ====================================
+# Preprocess scripts
+# ====================================
+
+class ScriptProfiler(object):
+    ''' Call counts, times, vertices touched and selection sizes of the ops a preprocess
+        script calls, per script line. Works whether span recording is on or not,
+        when it is every op also gets a span.
+        script_path - the file name the script was compiled with
+        probe - a function returning (vertices touched so far, selected vertices)
+                after each op, or None. See shapescripting.Stats '''
+    def __init__(self, script_path, probe = None):
+        self.scriptPath = script_path
+        self.probe = probe
+        # (line, op) = [calls, seconds, touched, selected]
+        self.lines = dict()
+
+    def Wrap(self, interface_dict):
+        # Purpose: a copy of interface_dict with every function in it timed, the rest as is
+        wrapped = dict(interface_dict)
+        for name, func in interface_dict.items():
+            if callable(func) and not isinstance(func, type):
+                wrapped[name] = self.__Timed(name, func)
+        return wrapped
+
+    def __Line(self):
+        # The innermost frame running the script itself
+        frame = sys._getframe(2)
+        while frame is not None and frame.f_code.co_filename != self.scriptPath:
+            frame = frame.f_back
+        return frame.f_lineno if frame is not None else 0
+
+    def __Timed(self, op, func):
+        @functools.wraps(func)
+        def Timed(*args, **kwargs):
+            line = self.__Line()
+            before = self.probe() if self.probe else None
+            startTime = time.perf_counter()
+            try:
+                with Span(op, line = line):
+                    return func(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - startTime
+                after = self.probe() if self.probe else None
+                self.__Add(line, op, seconds, before, after)
+        return Timed
+
+    def __Add(self, line, op, seconds, before, after):
+        stats = self.lines.get((line, op))
+        if stats is None:
+            stats = self.lines[(line, op)] = [0, 0.0, 0, 0]
+        stats[0] += 1
+        stats[1] += seconds
+        if after is not None:
+            stats[2] += after[0] - (before[0] if before is not None else 0)
+            stats[3] += after[1]
+
+    def Rows(self):
+        # Purpose: the statistics per script line and op, the slowest first
+        # 'selected' is the average selection size after the op
+        rows = []
+        for (line, op), (calls, seconds, touched, selected) in self.lines.items():
+            rows.append({'line': line, 'op': op, 'calls': calls, 'seconds': seconds,
+                         'touched': touched, 'selected': selected // calls,
+                         'source': linecache.getline(self.scriptPath, line).strip()})
+        rows.sort(key = lambda row: -row['seconds'])
+        return rows
+
+    def Report(self, limit = 20):
+        # Purpose: the hot lines of the script as a printable table
+        rows = self.Rows()
+        total = sum(row['seconds'] for row in rows)
+        lines = ['%s: %i ops, %.1f ms' % (os.path.basename(self.scriptPath),
+                                          sum(row['calls'] for row in rows), total * 1000),
+                 '%6s %6s %10s %6s %10s %8s  %s' % ('line', 'calls', 'total ms', '%', 'touched', 'sel', 'source')]
+        for row in rows[:limit]:
+            lines.append('%6i %6i %10.2f %6.1f %10i %8i  %s' % (row['line'], row['calls'], row['seconds'] * 1000,
+                         100.0 * row['seconds'] / total if total else 0.0, row['touched'],
+                         row['selected'], row['source'][:60]))
+        return '\n'.join(lines)
@@ -2,199 +2,337 @@
 # which affect what vertices will move when shapekey editing functions will be used
 # Keep in mind this has NO relation to Blender selections whatsoever
 
-import bpy, bmesh
-import math, random
-from math import sqrt
-from mathutils import Color, Vector
+import numpy
 
-import util
-from util import DebugPrint, GetMillisecs
+try:
+    import bpy, bmesh
+    from mathutils import Color
+except ImportError:
+    # Outside Blender, only the Debug_ helpers need these
+    bpy = bmesh = Color = None
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+import falloff, profiling, topology, util
+from util import DebugPrint
+
+# Sources x vertices distances the brute force Euclidean search works on at a time,
+# two float64 arrays of this many are alive at once (32 MB)
+BRUTE_FORCE_BLOCK = 1 << 21
+
+
+class Selection(Mapping):
+    ''' A vertex selection: sorted unique vertex indices and their float32 weights.
+        Reads like the legacy {index: weight} dicts, so old code can keep indexing it,
+        but all the operations below work on the arrays directly. 
+        n, if known, is the vertex count of the mesh. '''
+    def __init__(self, indices = None, weights = None, n = None):
+        if indices is None:
+            indices = numpy.zeros(0, dtype = numpy.int32)
+        self.indices = numpy.asarray(indices, dtype = numpy.int32)
+        if weights is None:
+            weights = numpy.ones(len(self.indices), dtype = numpy.float32)
+        self.weights = numpy.asarray(weights, dtype = numpy.float32)
+        self.n = n
+        
+    def __getitem__(self, index):
+        pos = numpy.searchsorted(self.indices, index)
+        if pos < len(self.indices) and self.indices[pos] == index:
+            return float(self.weights[pos])
+        raise KeyError(index)
+        
+    def __contains__(self, index):
+        pos = numpy.searchsorted(self.indices, index)
+        return bool(pos < len(self.indices) and self.indices[pos] == index)
+        
+    def __iter__(self):
+        return iter(self.indices.tolist())
+        
+    def __len__(self):
+        return len(self.indices)
+    
+    def __repr__(self):
+        return 'Selection(%i vertices, %i hard)' % (len(self.indices), numpy.count_nonzero(self.weights == 1.0))
+        
+    def Hard(self):
+        # Purpose: only the vertices with 1.0 weights
+        keep = self.weights == 1.0
+        return Selection(self.indices[keep], self.weights[keep], self.n)
+        
+    def ToDict(self):
+        # Purpose: the legacy {index: weight} form
+        return dict(zip(self.indices.tolist(), self.weights.tolist()))
+        
+    def Mask(self, n = None):
+        # Purpose: a dense float32 array of weights, 0.0 where not selected
+        n = n if n is not None else self.n
+        mask = numpy.zeros(n, dtype = numpy.float32)
+        mask[self.indices] = self.weights
+        return mask
+        
+
+def FromDict(vtx_weight_dict, n = None):
+    # Purpose: converts a legacy {index: weight} dict
+    count = len(vtx_weight_dict)
+    indices = numpy.fromiter(vtx_weight_dict.keys(), dtype = numpy.int32, count = count)
+    weights = numpy.fromiter(vtx_weight_dict.values(), dtype = numpy.float32, count = count)
+    order = numpy.argsort(indices, kind = 'stable')
+    return Selection(indices[order], weights[order], n)
+
+def FromMask(mask):
+    # Purpose: selects the vertices with non-zero weights in a dense weight array
+    mask = numpy.asarray(mask, dtype = numpy.float32)
+    indices = numpy.nonzero(mask)[0].astype(numpy.int32)
+    return Selection(indices, mask[indices], len(mask))
+
+def AsSelection(vtx_weight_dict, n = None):
+    # Purpose: accepts either a Selection or a legacy dict
+    if isinstance(vtx_weight_dict, Selection):
+        return vtx_weight_dict
+    return FromDict(vtx_weight_dict, n)
+
+def __IsIn(indices, other, n):
+    # Purpose: which of indices are also in the sorted array other
+    # Large selections of a known mesh go through a dense mask, small ones through sorting
+    if n is not None and len(indices) + len(other) > n // 8:
+        mask = numpy.zeros(n, dtype = bool)
+        mask[other] = True
+        return mask[indices]
+    if len(other) == 0:
+        return numpy.zeros(len(indices), dtype = bool)
+    pos = numpy.minimum(numpy.searchsorted(other, indices), len(other) - 1)
+    return other[pos] == indices
+
+def __VertexCount(a, b):
+    return a.n if a.n is not None else b.n
 
 
 def DiscardSoft(vtx_weight_dict):
     # Purpose: creates a new selection,
     # only with 1.0 weights
-    r = dict()
-    for v in vtx_weight_dict:
-        if vtx_weight_dict[v] == 1.0:
-            r[v] = 1.0
-    return r
+    return AsSelection(vtx_weight_dict).Hard()
      
-def Select(vtx_index_list):
+def Select(vtx_index_list, n = None):
 
     # Purpose: hard-select some vertices in a bmesh_in by indices.
     #             Mainly needed to have something selected before passing to BuildSoftSelection
-    # Returns: weigthdict wit1.0s by selected indeces
-    vwd = dict()
-    for i in vtx_index_list:
-        vwd[i] = 1.0
-    return vwd
+    # Returns: a Selection with 1.0s by selected indices
+    indices = numpy.unique(numpy.asarray(vtx_index_list, dtype = numpy.int32))
+    return Selection(indices, None, n)
 
 def SelectIntersect(vtx_weight_dict_a, vtx_weight_dict_b):
-    r = dict()
-    for v_i in vtx_weight_dict_a:
-        if v_i in vtx_weight_dict_b and vtx_weight_dict_a[v_i] == 1.0 and vtx_weight_dict_b[v_i] == 1.0:
-            r[v_i] = 1.0
-    return r
+    a = AsSelection(vtx_weight_dict_a).Hard()
+    b = AsSelection(vtx_weight_dict_b).Hard()
+    n = __VertexCount(a, b)
+    return Selection(a.indices[__IsIn(a.indices, b.indices, n)], None, n)
 
 def SelectAdd(vtx_weight_dict_a, vtx_weight_dict_b):
-    r = dict()
-    for v_i in vtx_weight_dict_a:
-        if vtx_weight_dict_a[v_i] == 1.0:
-            r[v_i] = 1.0
-    for v_i in vtx_weight_dict_b:
-        if vtx_weight_dict_b[v_i] == 1.0:
-            r[v_i] = 1.0
-    return r
+    a = AsSelection(vtx_weight_dict_a).Hard()
+    b = AsSelection(vtx_weight_dict_b).Hard()
+    n = __VertexCount(a, b)
+    extra = b.indices[~__IsIn(b.indices, a.indices, n)]
+    return Selection(numpy.sort(numpy.concatenate((a.indices, extra))), None, n)
 
 def SelectSubtract(vtx_weight_dict_a, vtx_weight_dict_b):
-    r = dict()
-    for v_i in vtx_weight_dict_a:
-        if v_i in vtx_weight_dict_b:
-            continue
-        r[v_i] = vtx_weight_dict_a[v_i]
-            
-    return r
+    a = AsSelection(vtx_weight_dict_a)
+    b = AsSelection(vtx_weight_dict_b)
+    n = __VertexCount(a, b)
+    keep = ~__IsIn(a.indices, b.indices, n)
+    return Selection(a.indices[keep], a.weights[keep], n)
 
 def SelectAll(bmesh_in):
-    vwd = dict()
+    # bmesh_in - a bmesh or a vertex count
+    n = bmesh_in if isinstance(bmesh_in, int) else len(bmesh_in.verts)
+    return Selection(numpy.arange(n, dtype = numpy.int32), None, n)
+             
+def SurfaceDistances(topo, sources, max_distance):
+    # Purpose: shortest edge-path distances from the sources, 
+    # a Dijkstra search that never expands past max_distance
+    # Returns: (reached vertex indices, their distances), sorted by index
+    import heapq
     
-    i = 0
-    for v in bmesh_in.verts:
-        i += 1
+    offsets, neighbours, lengths = topo.Lists()
+    best = dict()
+    heap = []
+    for v in sources:
+        best[v] = 0.0
+        heap.append((0.0, v))
+    heapq.heapify(heap)
     
-    for i in range(i):
-        vwd[i] = 1.0
-        
-    return vwd
+    while heap:
+        d, v = heapq.heappop(heap)
+        if d > best[v]:
+            # Stale entry, v was reached by a shorter path meanwhile
+            continue
+        for k in range(offsets[v], offsets[v + 1]):
+            nd = d + lengths[k]
+            if nd >= max_distance:
+                continue
+            u = neighbours[k]
+            if nd < best.get(u, max_distance):
+                best[u] = nd
+                heapq.heappush(heap, (nd, u))
+    
+    indices = numpy.fromiter(best.keys(), dtype = numpy.int32, count = len(best))
+    distances = numpy.fromiter(best.values(), dtype = numpy.float64, count = len(best))
+    order = numpy.argsort(indices)
+    return indices[order], distances[order]
+             
+def EuclideanDistances(topo, sources, max_distance):
+    # Purpose: straight-line distances to the nearest source, for vertices closer than max_distance
+    # Connected or not, so this reaches across lips and eyelids
+    # Returns: (reached vertex indices, their distances), sorted by index
+    sources = numpy.asarray(sources, dtype = numpy.int32)
+    tree = topo.KDTree()
+    if tree is not None:
+        found = []
+        for co in topo.positions[sources].tolist():
+            found.extend(tree.find_range(co, max_distance))
+        indices = numpy.fromiter((f[1] for f in found), dtype = numpy.int32, count = len(found))
+        dists = numpy.fromiter((f[2] for f in found), dtype = numpy.float64, count = len(found))
+    else:
+        # No mathutils, brute force in chunks of sources sized by BRUTE_FORCE_BLOCK.
+        # Squared distances are built one axis at a time, only the nearest ones get a sqrt.
+        positions = topo.positions.astype(numpy.float64)
+        step = max(1, BRUTE_FORCE_BLOCK // max(topo.n, 1))
+        nearest = numpy.full(topo.n, numpy.inf)
+        for start in range(0, len(sources), step):
+            chunk = positions[sources[start:start + step]]
+            d2 = numpy.subtract.outer(chunk[:, 0], positions[:, 0])
+            d2 *= d2
+            for axis in (1, 2):
+                diff = numpy.subtract.outer(chunk[:, axis], positions[:, axis])
+                diff *= diff
+                d2 += diff
+            numpy.minimum(nearest, d2.min(axis = 0), out = nearest)
+            d2 = diff = None
+        d = numpy.sqrt(nearest)
+        indices = numpy.nonzero(d < max_distance)[0].astype(numpy.int32)
+        dists = d[indices]
+
+    best = numpy.full(topo.n, numpy.inf)
+    numpy.minimum.at(best, indices, dists)
+    best[sources] = 0.0
+    reached = numpy.nonzero(best < max_distance)[0].astype(numpy.int32)
+    return reached, best[reached]
              
-def BuildSoftSelection(bmesh_in, vtx_weight_dict, falloff_distance, falloff_type):
+@profiling.Profiled()
+def BuildSoftSelection(bmesh_in, vtx_weight_dict, falloff_distance, falloff_type, use_connected = True,
+                       seed = falloff.DEFAULT_SEED):
     # Purpose: builds a soft selection
-    # bmesh_in - bbmesh_in object to run on
-    # vtx_weight_dict - a weightmap between vtx indices and weights
+    # bmesh_in - bmesh, mesh object or topology.MeshTopology to run on
+    # vtx_weight_dict - a Selection or weightmap between vtx indices and weights,
+    #                   only its hard (1.0) part matters
     # falloff_distance - proportional editing distance
     # falloff_type - 'SPIKE', 'BELL', 'LINEAR', 'RANDOM', 'DOME'
-    # use_connected - soft select only connected verts
-    # Returns: weights dictionary {vert_index = selection_weight}
+    # use_connected - soft select only connected verts: weights fall off with the distance along
+    #                 the surface from the nearest hard-selected vertex. Otherwise with the 
+    #                 straight-line distance, whether connected or not.
+    # seed - RANDOM falloff seed, see falloff.Weights
+    # Returns: Selection
     
     DISTANCE_MULTI = 2.0
-    falloff_distance *= DISTANCE_MULTI
-    
-    def GetWeight(distance, max, type):
-        if distance <= 0.0001:
-            return 1.0
-        if distance >= max: 
-            return 0.0
-        l = distance / max
-        if type == 'SPIKE':
-           return 1 - math.sqrt(2 * l - l * l)
-        if type == 'LINEAR':
-           return 1 - l
-        if type == 'DOME':
-            return sqrt(1 - l * l)
-        if type == 'BELL':
-            return (1 + 2 * l) * (1 - l) * (1 - l) # hermite h00  
-        if type == 'RANDOM':
-            return random.random()
-        
-        return 0.0
+    falloff_distance = abs(falloff_distance) * DISTANCE_MULTI
     
-    def WeightLinkedVtxVec(bmesh_in, index, vtx_weight_dict, falloff_distance, current_falloff_distance, falloff_type):
-        vert = bmesh_in.verts[index]
-        vtx_distance_dict = dict()
-        for e in vert.link_edges:
-            other = e.other_vert(vert)
-            other_vector = other.co - vert.co
-            w = GetWeight((current_falloff_distance + other_vector).length, falloff_distance, falloff_type)
-            if other.index in vtx_weight_dict:
-                if vtx_weight_dict[other.index] < w:
-                    vtx_weight_dict[other.index] = w
-                else:
-                    continue
-            if w > 0.0:
-                vtx_distance_dict[other.index] = other_vector + current_falloff_distance
-                vtx_weight_dict[other.index] = w
-        return vtx_weight_dict, vtx_distance_dict
-
-    # Maybe an overmeasure, but let's 'clean' the select dict from non 1.0 weights
+    topo = topology.AsTopology(bmesh_in)
+    hard = AsSelection(vtx_weight_dict, topo.n).Hard()
     
-    for i in range(len(bmesh_in.verts)):
-        if i in vtx_weight_dict:
-            if vtx_weight_dict[i] != 1.0:
-                vtx_weight_dict.pop(i)
-                
-    falloff_distance = abs(falloff_distance)
-     
-    bounces = 0
-    startTime = GetMillisecs()
-         
-    pre_step_dict = dict()    
-    distance = dict() # index = distance
+    if use_connected:
+        indices, distances = SurfaceDistances(topo, hard.indices.tolist(), falloff_distance)
+    else:
+        indices, distances = EuclideanDistances(topo, hard.indices, falloff_distance)
+    weights = falloff.Weights(distances, falloff_distance, falloff_type, seed, indices)
+    keep = weights > 0.0
     
-    # something something post 2.79 
-    if hasattr(bmesh_in.verts, "ensure_lookup_table"):
-        bmesh_in.verts.ensure_lookup_table()
-        
-    while True:
-        # 0. Determine vertices that are 'new' from the last iteration to speed up (could iterate over all vertices -- is this really a speedup?)
-        # NB: On fist iteration, they will all be 'new'
-        new_vtx = list(set(vtx_weight_dict.keys()) - set(pre_step_dict.keys()))
-        pre_step_dict = dict(vtx_weight_dict)
-        n_items = len(vtx_weight_dict)
-        # Weigth them
-        for index in new_vtx:
-            bounces += 1
-            if vtx_weight_dict[index] == 1.0:
-                # distance[index] = 0.0
-                distance[index] = Vector((0, 0, 0))
-            vtx_weight_dict, new_dists = WeightLinkedVtxVec(   bmesh_in = bmesh_in,
-                                                            index = index,
-                                                            vtx_weight_dict = vtx_weight_dict,
-                                                            falloff_distance = falloff_distance,
-                                                            current_falloff_distance = distance[index],
-                                                            falloff_type = falloff_type)
-            distance.update(new_dists)
-        if (len(vtx_weight_dict) == n_items):
-            #DebugPrint("BuildSoftSelection --- %i bounces %i" % (bounces, GetMillisecs() - startTime ), 3)
-            break
-        # If there's nothing added after the iteration, it means we selected everything we could add is added
-
-    return vtx_weight_dict     
+    DebugPrint("BuildSoftSelection --- %i verts" % numpy.count_nonzero(keep), 3)
+    return Selection(indices[keep], weights[keep], topo.n)
              
              
-def SelectMore(bmesh_in, vtx_weight_dict):
-    # Selects more vertices amount times
+def __Gather(topo, frontier):
+    # The neighbours of every frontier vertex, straight from the CSR arrays
+    starts = topo.offsets[frontier]
+    counts = topo.offsets[frontier + 1] - starts
+    total = int(counts.sum())
+    if total == 0:
+        return numpy.zeros(0, dtype = numpy.int32)
+    # Position of each gathered slot = its row start + its offset within the row
+    firsts = numpy.cumsum(counts) - counts
+    return topo.neighbours[numpy.repeat(starts - firsts, counts) + numpy.arange(total)]
+
+def RingDistances(mesh_in, sources, rings, inside = None):
+    # Purpose: edge-ring numbers from the sources, a breadth-first search that stops after rings steps
+    # inside - optional bool mask of vertices the search may enter
+    # Returns: int32 array over all vertices, -1 where not reached
+    topo = topology.AsTopology(mesh_in)
+    dist = numpy.full(topo.n, -1, dtype = numpy.int32)
+    frontier = numpy.unique(numpy.asarray(sources, dtype = numpy.int32))
+    dist[frontier] = 0
+    for ring in range(1, rings + 1):
+        reached = __Gather(topo, frontier)
+        reached = reached[dist[reached] < 0]
+        if inside is not None:
+            reached = reached[inside[reached]]
+        frontier = numpy.unique(reached)
+        if len(frontier) == 0:
+            break
+        dist[frontier] = ring
+    return dist
+
+@profiling.Profiled()
+def GrowRings(mesh_in, vtx_weight_dict, rings, falloff_type = None, seed = falloff.DEFAULT_SEED):
+    # Purpose: SelectMore rings times in one pass
+    # falloff_type - None for a hard selection, otherwise the added rings
+    #                get falloff weights of their ring number
+    topo = topology.AsTopology(mesh_in)
+    hard = AsSelection(vtx_weight_dict, topo.n).Hard()
+    dist = RingDistances(topo, hard.indices, max(int(rings), 0))
+    indices = numpy.nonzero(dist >= 0)[0].astype(numpy.int32)
+    if falloff_type is None:
+        return Selection(indices, None, topo.n)
+    weights = falloff.Weights(dist[indices], rings + 1, falloff_type, seed, indices)
+    return Selection(indices, weights, topo.n)
+
+@profiling.Profiled()
+def ShrinkRings(mesh_in, vtx_weight_dict, rings, falloff_type = None, seed = falloff.DEFAULT_SEED):
+    # Purpose: SelectLess rings times in one pass
+    # Hard-selected vertices within rings edges of an unselected one are dropped,
+    # the search starts at the selection border and only walks inwards
+    # falloff_type - None to drop them, otherwise they are kept with
+    #                falloff weights of how close they are to the border
+    topo = topology.AsTopology(mesh_in)
+    hard = AsSelection(vtx_weight_dict, topo.n).Hard().Mask(topo.n) > 0
+    rings = max(int(rings), 0)
+    e0 = topo.edges[:, 0]
+    e1 = topo.edges[:, 1]
+    border = numpy.concatenate((e0[hard[e1] & ~hard[e0]], e1[hard[e0] & ~hard[e1]]))
+    dist = RingDistances(topo, border, rings, hard)
+    keep = hard & (dist < 0)
+    if falloff_type is None:
+        return FromMask(keep)
+    eroded = numpy.nonzero(hard & (dist > 0))[0]
+    weights = keep.astype(numpy.float32)
+    weights[eroded] = falloff.Weights(rings + 1 - dist[eroded], rings + 1, falloff_type, seed, eroded)
+    return FromMask(weights)
+
+def SelectMore(mesh_in, vtx_weight_dict):
+    # Selects the hard-selected vertices and their neighbours
     # Takes into consideration only vertices that are 'hard-selected'
-    ret = dict()
-    for v in bmesh_in.verts:
-        if v.index in vtx_weight_dict:
-            if vtx_weight_dict[v.index] == 1.0:
-                ret[v.index] = 1.0
-                for e in v.link_edges:
-                    ret[e.other_vert(v).index] = 1.0
-    return ret
+    # mesh_in is a MeshTopology, a bmesh or a mesh object
+    return GrowRings(mesh_in, vtx_weight_dict, 1)
     
-def SelectLess(bmesh_in, vtx_weight_dict):
-    vtx_weight_dict = DiscardSoft(vtx_weight_dict)
-    ret = dict()
-    for v in bmesh_in.verts:
-        if v.index in vtx_weight_dict:
-            nE = len(v.link_edges)
-            nSE = 0
-            for e in v.link_edges:
-                other_i = e.other_vert(v).index
-                if other_i in vtx_weight_dict:
-                    nSE += 1
-            if nE == nSE:
-                ret[v.index] = 1.0          
-    return ret
+def SelectLess(mesh_in, vtx_weight_dict):
+    # Keeps the hard-selected vertices whose neighbours are all hard-selected
+    return ShrinkRings(mesh_in, vtx_weight_dict, 1)
                     
     
 def Debug_DictToCols(not_a_bmesh_in, vtx_weight_dict, name):
     # Purpose: writes vertex colors based on weight list to the bmesh_in (not a bbmesh_in please) for visual debugging 
     # White = 1
     # Black = 0
-    d = vtx_weight_dict
+    d = AsSelection(vtx_weight_dict).ToDict()
             
     my_object = not_a_bmesh_in.data
     vert_list = my_object.vertices
@@ -0,0 +1,140 @@
+# Purpose: bulk access to shape key and basis coordinates
+# Whole shape keys are read and written as contiguous float32 arrays of shape (n, 3)
+# through foreach_get / foreach_set instead of walking shape.data[i].co vertex by vertex
+
+from collections import OrderedDict
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+import hashlib
+
+import numpy
+
+import hwmcore, profiling, selections, topology, util
+from util import DebugPrint
+
+# mesh name = (vertex count, basis coordinates)
+__basisCache = dict()
+
+
+def VertexCount(mesh):
+    return len(mesh.data.vertices)
+
+def NewCoords(n):
+    # Purpose: a zeroed (n, 3) coordinate buffer
+    return numpy.zeros((n, 3), dtype = numpy.float32)
+
+def GetBasisCoords(mesh):
+    # Purpose: returns the rest positions of mesh's vertices
+    # The array is cached per mesh and is read-only, copy it before modifying!
+    n = VertexCount(mesh)
+    cached = __basisCache.get(mesh.name)
+    if cached and cached[0] == n:
+        return cached[1]
+
+    co = NewCoords(n)
+    mesh.data.vertices.foreach_get('co', co.ravel())
+    co.flags.writeable = False
+    __basisCache[mesh.name] = (n, co)
+    DebugPrint('shapebuffers: cached basis of %s (%i verts)' % (mesh.name, n), 3)
+    return co
+
+def InvalidateBasis(mesh = None):
+    # Purpose: forgets the cached basis of mesh, or of every mesh if None
+    # Call this whenever the base vertex positions might have changed
+    if mesh is None:
+        __basisCache.clear()
+    else:
+        __basisCache.pop(mesh.name, None)
+
+def GetShapeCoords(shape, out = None):
+    # Purpose: reads all of shape's coordinates into an (n, 3) array
+    if out is None:
+        out = NewCoords(len(shape.data))
+    shape.data.foreach_get('co', out.ravel())
+    return out
+
+def SetShapeCoords(shape, co):
+    # Purpose: writes an (n, 3) array into shape in one go
+    co = numpy.ascontiguousarray(co, dtype = numpy.float32)
+    if len(co) != len(shape.data):
+        raise ValueError('Shape %s has %i points, got %i coordinates' %
+                            (shape.name, len(shape.data), len(co)))
+    shape.data.foreach_set('co', co.ravel())
+
+def GetShapeDelta(mesh, shape):
+    # Purpose: shape's displacement against the mesh basis
+    return GetShapeCoords(shape) - GetBasisCoords(mesh)
+
+def SetShapeDelta(mesh, shape, delta):
+    # Purpose: stores a displacement against the mesh basis as shape's coordinates
+    SetShapeCoords(shape, GetBasisCoords(mesh) + delta)
+
+def HashCoords(co):
+    # Purpose: a content hash of an (n, 3) array, equal only for bit-identical coordinates
+    co = numpy.ascontiguousarray(co, dtype = numpy.float32)
+    return hashlib.sha1(co.tobytes()).hexdigest()
+
+def HashShape(shape):
+    return HashCoords(GetShapeCoords(shape))
+
+def WeightArrays(vtx_weight_dict):
+    # Purpose: the sorted index array and float32 weight array of a selection
+    # vtx_weight_dict - a selections.Selection or a legacy index = weight dict
+    sel = selections.AsSelection(vtx_weight_dict)
+    return sel.indices, sel.weights
+
+
+class ShapeDeltas(Mapping):
+    ''' A read-only {shape name = delta} view of some of mesh's shape keys.
+        Deltas are read from Blender on access, so nothing is held in memory. '''
+    def __init__(self, mesh, names):
+        self.mesh = mesh
+        self.names = list(names)
+        self.__lookup = set(self.names)
+        
+    def __getitem__(self, name):
+        if name not in self.__lookup:
+            raise KeyError(name)
+        return GetShapeDelta(self.mesh, self.mesh.data.shape_keys.key_blocks[name])
+    
+    def __contains__(self, name):
+        return name in self.__lookup
+        
+    def __iter__(self):
+        return iter(self.names)
+        
+    def __len__(self):
+        return len(self.names)
+
+
+@profiling.Profiled()
+def LoadModel(mesh, names = None):
+    # Purpose: reads mesh into a hwmcore.FaceModel: its basis, its connectivity
+    # and the shapes named names, every shape but the reference key by default
+    keys = mesh.data.shape_keys
+    basis = GetBasisCoords(mesh)
+    if names is None:
+        shapes = [shape for shape in keys.key_blocks if shape != keys.reference_key]
+    else:
+        shapes = [keys.key_blocks[name] for name in names]
+    deltas = OrderedDict((shape.name, GetShapeCoords(shape) - basis) for shape in shapes)
+    return hwmcore.FaceModel(basis, deltas, lambda: topology.GetTopology(mesh))
+
+@profiling.Profiled()
+def StoreShapes(model, mesh, names = None):
+    # Purpose: writes shapes of model back into mesh, every shape by default
+    # Shapes mesh doesn't have yet are added
+    import shapetools
+    names = model.Names() if names is None else list(names)
+    missing = [name for name in names if not shapetools.FindShapeKey(mesh, name, True)]
+    shapetools.AddShapeKeys(mesh, missing)
+    for name in names:
+        SetShapeDelta(mesh, shapetools.FindShapeKey(mesh, name, True), model.shapes[name])
+
+
+DebugPrint('shapebuffers.py reloaded...')
+
@@ -0,0 +1,122 @@
+# Purpose: shape name parsing
+# A shape name is a list of controllers joined with '_', CloseLid25_CloseLidLo12 etc.
+# Names are parsed once, the resulting ShapeName objects are cached per string
+# and shared by validation, rank checks and shape key lookups.
+#
+# Valid names are what the old validation regexp accepted:
+#   ^([A-Z|a-z]{1,100}[0-9]{0,100}_){0,50}(([A-Z|a-z]{1,100}[0-9]{0,100}){1,100})$
+# i. e. up to 50 controllers of letters followed by digits, and a last controller
+# that may repeat that letters-digits pattern up to 100 times. ('|' counts as a letter,
+# as it did in the regexp.) The one difference: Python's $ also matches before a
+# trailing newline, so the regexp let 'A\n' and 'A_B\n' through. The scanner rejects
+# them, as the regexp would have with \Z. It checks all this in a single pass instead
+# of backtracking.
+
+from itertools import combinations
+
+MAX_SEPARATORS = 50
+MAX_RUN = 100
+MAX_LAST_GROUPS = 100
+
+__letters = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz|')
+__digits = frozenset('0123456789')
+
+# name = ShapeName
+__parsed = dict()
+
+
+class ShapeName(object):
+    ''' A parsed shape name. Equal and hashed by its controller set,
+        so A_B and b_a are the same shape as far as lookups go. '''
+    __slots__ = ('name', 'controllers', 'key', 'canonical', 'rank', 'valid', 'isCorrector')
+
+    def __init__(self, name, controllers, valid):
+        self.name = name
+        self.controllers = controllers
+        self.key = frozenset(c.lower() for c in controllers)
+        self.canonical = tuple(sorted(self.key))
+        self.rank = len(controllers)
+        self.valid = valid
+        self.isCorrector = valid and self.rank > 1
+
+    def CanonicalName(self):
+        return '_'.join(self.canonical)
+
+    def __eq__(self, other):
+        return isinstance(other, ShapeName) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return 'ShapeName(%r)' % self.name
+
+
+def __Scan(name):
+    # Purpose: the linear-time validity check, see the top of the file
+    # The last controller may chain letters-digits groups, each group holds
+    # at most MAX_RUN letters, so a long letter run needs several groups
+    if name.count('_') > MAX_SEPARATORS:
+        return False
+
+    controllers = name.split('_')
+    last = len(controllers) - 1
+    for c, controller in enumerate(controllers):
+        groups = 0
+        i = 0
+        n = len(controller)
+        if n == 0:
+            return False
+        while i < n:
+            start = i
+            while i < n and controller[i] in __letters:
+                i += 1
+            letters = i - start
+            if letters == 0:
+                # Digits first or some other character
+                return False
+            start = i
+            while i < n and controller[i] in __digits:
+                i += 1
+            if i - start > MAX_RUN:
+                return False
+            if c < last:
+                if letters > MAX_RUN or i < n:
+                    return False
+            else:
+                groups += (letters + MAX_RUN - 1) // MAX_RUN
+        if groups > MAX_LAST_GROUPS:
+            return False
+    return True
+
+def Parse(name):
+    # Purpose: returns the cached ShapeName of name, parsing it the first time
+    # Invalid names are parsed too (valid = False), their rank is the number of '_'-separated parts
+    parsed = __parsed.get(name)
+    if parsed is None:
+        parsed = ShapeName(name, tuple(name.split('_')), __Scan(name))
+        __parsed[name] = parsed
+    return parsed
+
+def IsValid(name):
+    return Parse(name).valid
+
+def FindInvalid(names):
+    # Purpose: validates a batch of names in one call
+    # Returns: the invalid ones, in order
+    return [name for name in names if not Parse(name).valid]
+
+def SubShapeNames(name):
+    # Purpose: for A_B, generates A & B, for A_B_C generates A, B, C, A_B, A_C, B_C etc
+    parsed = Parse(name)
+    if not parsed.isCorrector:
+        return
+    for rank in range(1, parsed.rank):
+        for subShape in combinations(parsed.controllers, rank):
+            yield '_'.join(subShape)
@@ -3,37 +3,60 @@ from selections import *
 
 import bpy, bmesh
 
-from mathutils import Vector
+from collections import OrderedDict
 
-import obtools, util
-from util import DebugPrint, GetMillisecs
+import hwmcore, profiling, shapebuffers, util
+from util import DebugPrint
 
-import re
-__validShapeRegexp = re.compile(
-            "^([A-Z|a-z]{1,100}[0-9]{0,100}_){0,50}(([A-Z|a-z]{1,100}[0-9]{0,100}){1,100})$")
-            
-# ^([A-Z|a-z]{1,100}[0-9]{0,25}_) : e. g. CloseLid25_CloseLidLo12_, A_B_C_D_...
+import shapenames
+
+# Shape names are parsed and validated by shapenames, 
+# e. g. CloseLid25_CloseLidLo12, A_B_C_D...
 
 # Interp and Add operations involve a dictionary that maps vertex indices to their weights: index = weight (vtx_weight_dict)
 # All these are operating on regular meshes
 
 def IsCorrectorShapeName(shapeName):
-    return (__validShapeRegexp.match(shapeName) and ('_' in shapeName))
+    return shapenames.Parse(shapeName).isCorrector
+
+# mesh name = [key block count, {frozenset of lowercase controllers = key}, {lowercase name = key}]
+# Kept up to date by AddShapeKey / RemoveShapeKey, anything renaming or removing
+# keys behind their back must call InvalidateShapeIndex
+__shapeIndexCache = dict()
+
+def __IndexShape(index, shape):
+    # The first of several matching keys wins, like a scan over key_blocks would
+    name = shape.name.lower()
+    index[1].setdefault(shapenames.Parse(name).key, shape)
+    index[2].setdefault(name, shape)
+
+def __GetShapeIndex(mesh):
+    keys = mesh.data.shape_keys.key_blocks
+    index = __shapeIndexCache.get(mesh.name)
+    if index and index[0] == len(keys):
+        return index
+    
+    index = [len(keys), dict(), dict()]
+    for shape in keys:
+        __IndexShape(index, shape)
+    __shapeIndexCache[mesh.name] = index
+    return index
+
+def InvalidateShapeIndex(mesh = None):
+    # Purpose: forgets the shape key index of mesh, or of every mesh if None
+    if mesh is None:
+        __shapeIndexCache.clear()
+    else:
+        __shapeIndexCache.pop(mesh.name, None)
 
 def FindShapeKey(mesh, name, exact_mode = False):   
+    # Purpose: finds a shape key by name, case-insensitive
+    # Unless exact_mode, the order of controllers doesn't matter: A_B finds B_A
     name = name.lower()
+    index = __GetShapeIndex(mesh)
     if exact_mode:
-        for shape in mesh.data.shape_keys.key_blocks:
-            if shape.name.lower() == name.lower():
-                return shape
-        return None
-          
-    affControllersSearch = set(name.split('_'))
-    for shape in mesh.data.shape_keys.key_blocks:
-        affControllersCandidate = set(shape.name.lower().split('_'))
-        if affControllersCandidate == affControllersSearch:
-            return shape
-    return None
+        return index[2].get(name)
+    return index[1].get(shapenames.Parse(name).key)
   
 def GetShapeRank(name):
     # Returns the shape's rank by its name
@@ -41,8 +64,17 @@ def GetShapeRank(name):
     #   GetShapeRank('A')       =   1
     #   GetShapeRank('A_B')     =   2
     #   GetShapeRank('A_B_C')   =   3
-    return len(name.split('_'))
+    return shapenames.Parse(name).rank
              
+def __NewShapeKey(mesh, name):
+    # Through the data API, so no context, no UI updates and it works in background mode
+    new = mesh.shape_key_add(name = name, from_mix = False)
+    index = __shapeIndexCache.get(mesh.name)
+    if index:
+        index[0] += 1
+        __IndexShape(index, new)
+    return new
+
 def AddShapeKey(mesh, name, overwrite = False):
     # Adds a shape key named name on the mesh
     # Can overwrite
@@ -56,25 +88,31 @@ def AddShapeKey(mesh, name, overwrite = False):
                     raise ValueError('Cannot overwrite shape key %s on mesh %s \
                                 - use overwrite = True!' % (name, mesh.name))
             
-            orig_area = bpy.context.area.type
-            orig_scene = bpy.context.scene
-            orig_active_obj = bpy.context.active_object
-            
-            bpy.context.screen.scene = obtools.GetObjectScene(mesh)
-            bpy.context.scene.objects.active = mesh
-            
-            bpy.context.area.type = "VIEW_3D"
-            old = mesh.active_shape_key
-            
-            bpy.context.scene.objects.active = mesh
-            bpy.ops.object.shape_key_add(from_mix = False)
-            new = mesh.active_shape_key
-            mesh.active_shape_key.name = name
-            
-            bpy.context.area.type = orig_area
-            bpy.context.screen.scene = orig_scene
-            bpy.context.scene.objects.active = orig_active_obj
-            return new
+            return __NewShapeKey(mesh, name)
+    
+@profiling.Profiled()
+def AddShapeKeys(mesh, names, coords = None, overwrite = False):
+    # Purpose: adds many shape keys in one go
+    # coords - optional absolute (n, 3) coordinates for each name, in the same order,
+    #          None entries are left at the basis
+    # Nothing is added if any name is taken and overwrite is False
+    # Returns: the new keys, in order
+    names = list(names)
+    if coords is not None and len(coords) != len(names):
+        raise ValueError('%i names but %i coordinate arrays' % (len(names), len(coords)))
+    
+    taken = [name for name in names if FindShapeKey(mesh, name)]
+    if taken and not overwrite:
+        raise ValueError('Cannot overwrite shape keys %s on mesh %s - use overwrite = True!' 
+                         % (', '.join(taken), mesh.name))
+    RemoveShapeKeys(mesh, taken)
+    
+    new = [__NewShapeKey(mesh, name) for name in names]
+    if coords is not None:
+        for key, co in zip(new, coords):
+            if co is not None:
+                shapebuffers.SetShapeCoords(key, co)
+    return new
     
 def RemoveShapeKey(mesh, name):
     if mesh:
@@ -82,19 +120,23 @@ def RemoveShapeKey(mesh, name):
             if (len(name) > 0):
                 delkey = FindShapeKey(mesh, name)
                 if delkey:
-                    orig_area = bpy.context.area.type
-                    orig_scene = bpy.context.scene
-                    orig_active_obj = bpy.context.active_object
+                    mesh.shape_key_remove(delkey)
+                    InvalidateShapeIndex(mesh)
                     
-                    bpy.context.screen.scene = obtools.GetObjectScene(mesh)
-                    bpy.context.scene.objects.active = mesh
-            
-                    mesh.active_shape_key_index = mesh.data.shape_keys.key_blocks.keys().index(delkey.name)
-                    bpy.ops.object.shape_key_remove()
-                    
-                    bpy.context.area.type = orig_area
-                    bpy.context.screen.scene = orig_scene
-                    bpy.context.scene.objects.active = orig_active_obj
+@profiling.Profiled()
+def RemoveShapeKeys(mesh, names):
+    # Purpose: removes many shape keys in one go, names that aren't found are skipped
+    if not mesh or not mesh.data.shape_keys:
+        return
+    keys = OrderedDict()
+    for name in names:
+        key = FindShapeKey(mesh, name)
+        if key:
+            keys[key.name] = key
+    for key in keys.values():
+        mesh.shape_key_remove(key)
+    if keys:
+        InvalidateShapeIndex(mesh)
                     
 def HasShapes(mesh):
     return mesh.type == 'MESH' and mesh.data.shape_keys and len(mesh.data.shape_keys.key_blocks) > 1 and \
@@ -103,34 +145,17 @@ def HasShapes(mesh):
    
 
 def GetDeltaCoords(mesh, shape):
-    # Gets a list of delta vectors for that shape against the base mesh state
-    c = []
-    for i in range(len(mesh.data.vertices)):
-        c.append(shape.data[i].co - mesh.data.vertices[i].co)
-    return c
+    # Gets an (n, 3) array of delta vectors for that shape against the base mesh state
+    return shapebuffers.GetShapeDelta(mesh, shape)
     
 def YeildSubShapeNames(name):
-     # Purpose: for A_B, generates A & B, for A_B_C generates A, B, C, A_B, A_C, B_C etc
-    
-    def NameSet2ShapeName(nameSet):
-        return '_'.join(list(nameSet))
-    
-    def Combinations(iter):
-        # Some super-code 
-        from itertools import compress, product
-        return ( set(compress(iter,mask)) for mask in product(*[[0,1]]*len(iter)) )
-        
-    if not IsCorrectorShapeName(name):
-        return
-    
-    rank = GetShapeRank(name)
-    
-    baseShapes = name.split('_')
-    for subShapeSet in Combinations(baseShapes):
-        if len(subShapeSet) < 1 or len(subShapeSet) == rank:
-            continue
-        yield NameSet2ShapeName(subShapeSet)
+    # Purpose: for A_B, generates A & B, for A_B_C generates A, B, C, A_B, A_C, B_C etc
+    return shapenames.SubShapeNames(name)
 
+# The array kernels live in hwmcore
+InterpCoords = hwmcore.InterpCoords
+AddCoords = hwmcore.AddCoords
+TranslateCoords = hwmcore.TranslateCoords
        
 def Interp(mesh, vtx_weight_dict, shapekey_in, shapekey_out, amount):
     # Purpose: interprets shapekey_out towards shapekey_in, 
@@ -141,54 +166,29 @@ def Interp(mesh, vtx_weight_dict, shapekey_in, shapekey_out, amount):
     if (shapekey_in not in mesh.data.shape_keys.key_blocks.values()):
         return None 
     
-    vw = vtx_weight_dict
-    in_verts = shapekey_in.data
-    out_verts = shapekey_out.data
-
-    for i in range(len(in_verts)):
-        if i in vw:
-            diff = in_verts[i].co - out_verts[i].co
-            out_verts[i].co += diff * amount * vw[i]
-        else:
-            continue
+    out_co = shapebuffers.GetShapeCoords(shapekey_out)
+    InterpCoords(out_co, shapebuffers.GetShapeCoords(shapekey_in), vtx_weight_dict, amount)
+    shapebuffers.SetShapeCoords(shapekey_out, out_co)
 
 def Add(mesh, vtx_weight_dict, shapekey_in, shapekey_out, amount):
     # Purpose: adds delta displacements from shapekey_in to shapekey_out
     # is controlled by amount and index-weight dict
-    in_verts_co = GetDeltaCoords(mesh, shapekey_in)
-    out_verts = shapekey_out.data
-    vwd = vtx_weight_dict
-    n = len(in_verts_co)
-    for i in range(n):
-        if i in vwd:
-            diff = vwd[i] * amount * in_verts_co[i]
-            out_verts[i].co = out_verts[i].co + diff
-        else:
-            # if not weighed, it's zero and not to be moved
-            continue 
+    # if not weighed, it's zero and not to be moved
+    out_co = shapebuffers.GetShapeCoords(shapekey_out)
+    AddCoords(out_co, GetDeltaCoords(mesh, shapekey_in), vtx_weight_dict, amount)
+    shapebuffers.SetShapeCoords(shapekey_out, out_co)
 
 def Translate(mesh, vtx_weight_dict, shapekey_out, dx, dy, dz):
     # Purpose: translate vertices in the weight dict somewhere
-    verts = shapekey_out.data
-    vwd = vtx_weight_dict
-    
-    d = Vector((0,0,0))
-    
-    for i in range(len(verts)):
-        if i in vwd:
-            d.x = dx
-            d.y = dy
-            d.z = dz
-            verts[i].co += vwd[i] * d
-        else:
-            continue
+    out_co = shapebuffers.GetShapeCoords(shapekey_out)
+    TranslateCoords(out_co, vtx_weight_dict, dx, dy, dz)
+    shapebuffers.SetShapeCoords(shapekey_out, out_co)
 
 
 def CopyShapeKey(shape_in, shape_out):
     # Copies shape_in to shape_out
     # The indices between the meshes MUST match
-    for i in range(len(shape_in.data)):
-        shape_out.data[i].co = shape_in.data[i].co
+    shapebuffers.SetShapeCoords(shape_out, shapebuffers.GetShapeCoords(shape_in))
         
         
 def ValidateShapeNames(mesh):
@@ -196,40 +196,35 @@ def ValidateShapeNames(mesh):
     if (not mesh):
         return False
       
-    for s in mesh.data.shape_keys.key_blocks:
-        match = __validShapeRegexp.match(s.name)
-        if (not match):
-            print ("Invalid shape name %s!" %  s.name)
-            return False
+    invalid = shapenames.FindInvalid(mesh.data.shape_keys.key_blocks.keys())
+    for name in invalid:
+        print ("Invalid shape name %s!" % name)
     
-    return True    
+    return not invalid
         
+def FindRedundantCorrectives(mesh):
+    # Purpose: groups corrective shapes by controller set
+    # Returns: a list of every group of shape names driven by the same controllers, 
+    #          e. g. [['A_B', 'B_A'], ['A_C_D', 'D_A_C', 'C_D_A']]
+    groups = OrderedDict()
+    for shape in mesh.data.shape_keys.key_blocks:
+        parsed = shapenames.Parse(shape.name)
+        if parsed.rank < 2:
+            continue
+        groups.setdefault(parsed.key, []).append(shape.name)
+    
+    return [group for group in groups.values() if len(group) > 1]
+    
 def CheckForRedundantCorrectives(mesh):
     
     if (not mesh):
         return False
     
-    shapes = mesh.data.shape_keys.key_blocks
-    
-    for i in range(len(shapes)):
-        if (GetShapeRank(shapes[i].name) < 2):
-            continue
-        
-        nameSet = set(shapes[i].name.lower().split('_'))
-        
-        for j in range(i + 1, len(shapes)): 
-            
-            if (GetShapeRank(shapes[j].name) < 2):
-                continue
-            
-            searchNameSet = set(shapes[j].name.lower().split('_'))
+    redundant = FindRedundantCorrectives(mesh)
+    for group in redundant:
+        print ('Ambiguous corrective shapes found: %s!' % ', '.join(group))
             
-            if (nameSet == searchNameSet):
-                print ('Ambiguous corrective shapes found: %s and %s!' %
-                                 (shapes[i].name, shapes[j].name))
-                return False
-            
-    return True
+    return not redundant
                 
                    
 def Corr_RelToAbs(mesh_in, mesh_out, shapekey_in_rel, shapekey_out_abs):
@@ -248,26 +243,18 @@ def Corr_RelToAbs(mesh_in, mesh_out, shapekey_in_rel, shapekey_out_abs):
             subKeys.append(key)
         else:
             if (GetShapeRank(subKeyName) < 2):
-                print ('Base shape %s not found while processing corrective shape %s' % (subKeyName, shapekey_in_abs.name) )
+                print ('Base shape %s not found while processing corrective shape %s' % (subKeyName, shapekey_in_rel.name) )
                 return None
 
-    subMix_co = []
-    # Can loop on key-vtx, or on vtx-key. This is the latter, 
-    
-    for i in range(len(shapekey_out_abs.data)):
-        subMix_co.append(Vector((0,0,0)))
-    
+    subMix_co = shapebuffers.NewCoords(len(shapekey_out_abs.data))
     for k in subKeys:
-        delta_co = GetDeltaCoords(mesh_in, k)
-        for i in range(len(shapekey_out_abs.data)):
-            subMix_co[i] += delta_co[i]
+        subMix_co += GetDeltaCoords(mesh_in, k)
                   
-    CopyShapeKey(shapekey_in_rel, shapekey_out_abs)
-    
-    for i in range(len(shapekey_out_abs.data)):
-        shapekey_out_abs.data[i].co += subMix_co[i]
+    shapebuffers.SetShapeCoords(shapekey_out_abs, 
+                                shapebuffers.GetShapeCoords(shapekey_in_rel) + subMix_co)
                 
 
+@profiling.Profiled()
 def Corr_AbsToRel(mesh_in, mesh_out, shapekey_in_abs, shapekey_out_rel):
     ''' Purpose: saves this corrector as a rel shape,
                  apporopriately checks for sub-shapes ON THE IN MESH
@@ -280,8 +267,6 @@ def Corr_AbsToRel(mesh_in, mesh_out, shapekey_in_abs, shapekey_out_rel):
         raise ValueError('Different meshes specified.')       
         
     subKeys = []   
-    
-    startTime = GetMillisecs()
              
     for subKeyName in YeildSubShapeNames(shapekey_in_abs.name):
         key = FindShapeKey(mesh_out, subKeyName)
@@ -294,25 +279,22 @@ def Corr_AbsToRel(mesh_in, mesh_out, shapekey_in_abs, shapekey_out_rel):
            
     [DebugPrint(" " + subKey.name, 3) for subKey in subKeys]
     
-    subMix_co = []
-    # Can loop on key-vtx, or on vtx-key. This is the latter, 
-    for i in range(len(shapekey_in_abs.data)):
-        subMix_co.append(Vector((0,0,0)))
-    
+    subMix_co = shapebuffers.NewCoords(len(shapekey_in_abs.data))
     for k in subKeys:
-        delta_co = GetDeltaCoords(mesh_in, k)
-        for i in range(len(shapekey_in_abs.data)):
-            subMix_co[i] += delta_co[i]
+        subMix_co += GetDeltaCoords(mesh_in, k)
             
-    CopyShapeKey(shapekey_in_abs, shapekey_out_rel)
-    
-    for i in range(len(shapekey_out_rel.data)):
-        shapekey_out_rel.data[i].co -= subMix_co[i]  
-    
-    DebugPrint("AbsToRel: %i" % (GetMillisecs() - startTime), 2)
+    shapebuffers.SetShapeCoords(shapekey_out_rel, 
+                                shapebuffers.GetShapeCoords(shapekey_in_abs) - subMix_co)
     
     return True 
     
+def LatticeShapeNames(mesh):
+    # Purpose: names of the shapes taking part in abs/rel conversion --
+    # every validly named shape but the basis (no selectors, no temp keys)
+    keys = mesh.data.shape_keys
+    return [shape.name for shape in keys.key_blocks 
+                if shape != keys.reference_key and shapenames.IsValid(shape.name)]
+    
 def EstimateWrinkleScale(mesh, shapekey):
     ''' Purpose: returns wrinklemap scale based on vertices displacement '''
     raise ValueError('Not implemented')
@@ -0,0 +1,208 @@
+# Purpose: sparse shape deltas
+# Most facial shapes only move a small region of the head, so a delta can be kept as
+# the sorted indices of the vertices it moves plus their float32 offsets.
+# Sparse deltas only pay off when few vertices move: a dense (n, 3) add is a single
+# vectorized pass, while every sparse op scatters and gathers. Compact keeps a delta
+# sparse only below SPARSE_DENSITY, and the functions here (Add, Subtract, Merge,
+# SubtractAll, ToDense) take dense and sparse deltas alike. They give the same numbers
+# either way.
+
+import threading
+
+import numpy
+
+# Offsets whose largest component is at or below this are dropped by FromDense,
+# 0.0 keeps every vertex that moves at all and loses nothing
+DEFAULT_EPSILON = 0.0
+
+# Deltas moving at most this share of the vertices are kept sparse by Compact, and sums
+# of sparse deltas going over it come out dense. Measured with benchmark.py AbsToRel,
+# see Compact.
+SPARSE_DENSITY = 0.02
+
+__scratch = threading.local()
+
+
+class SparseDelta(object):
+    ''' n - vertex count of the mesh
+        indices - sorted int32 array of moved vertices
+        offsets - (len(indices), 3) float32 array of their displacements '''
+    __slots__ = ('n', 'indices', 'offsets')
+
+    def __init__(self, n, indices, offsets):
+        self.n = n
+        self.indices = indices
+        self.offsets = offsets
+
+    def __len__(self):
+        # How many vertices are stored
+        return len(self.indices)
+
+    def ToDense(self):
+        # Purpose: expands to an (n, 3) array
+        dense = numpy.zeros((self.n, 3), dtype = numpy.float32)
+        dense[self.indices] = self.offsets
+        return dense
+
+    def Copy(self):
+        return SparseDelta(self.n, self.indices.copy(), self.offsets.copy())
+
+    def Scale(self, factor):
+        return SparseDelta(self.n, self.indices, self.offsets * numpy.float32(factor))
+
+    def Add(self, other):
+        return Add(self, other)
+
+    def Subtract(self, other):
+        return Subtract(self, other)
+
+    __add__ = Add
+    __sub__ = Subtract
+
+    def __neg__(self):
+        return SparseDelta(self.n, self.indices, -self.offsets)
+
+    def __mul__(self, factor):
+        return self.Scale(factor)
+
+    __rmul__ = __mul__
+
+    def __repr__(self):
+        return 'SparseDelta(%i of %i vertices)' % (len(self.indices), self.n)
+
+
+def Empty(n):
+    return SparseDelta(n, numpy.zeros(0, dtype = numpy.int32),
+                       numpy.zeros((0, 3), dtype = numpy.float32))
+
+def __Moved(delta, epsilon):
+    # The sorted rows of an (n, 3) float32 delta with a component over epsilon.
+    # Reductions along the short axis are slow in NumPy, so this goes through the flat array.
+    components = numpy.flatnonzero(numpy.abs(delta).reshape(-1) > epsilon) // 3
+    if len(components) == 0:
+        return components.astype(numpy.int32)
+    first = numpy.empty(len(components), dtype = bool)
+    first[0] = True
+    numpy.not_equal(components[1:], components[:-1], out = first[1:])
+    return components[first].astype(numpy.int32)
+
+def FromDense(delta, epsilon = DEFAULT_EPSILON):
+    # Purpose: keeps the vertices of an (n, 3) delta that move by more than epsilon
+    delta = numpy.ascontiguousarray(delta, dtype = numpy.float32)
+    indices = __Moved(delta, epsilon)
+    return SparseDelta(len(delta), indices, delta[indices])
+
+def Compact(delta, epsilon = DEFAULT_EPSILON, density = SPARSE_DENSITY):
+    # Purpose: the cheapest form of an (n, 3) delta to do arithmetic with
+    # Returns: a SparseDelta if at most density * n vertices move by more than epsilon,
+    #          otherwise a float32 (n, 3) array with the offsets up to epsilon zeroed.
+    #          SparseDeltas are returned as they are.
+    # Dense shapes are told apart by counting components, one fast pass over the array,
+    # the moved vertices are only looked for in shapes that may be sparse.
+    if isinstance(delta, SparseDelta):
+        return delta
+    delta = numpy.ascontiguousarray(delta, dtype = numpy.float32)
+    n = len(delta)
+    if numpy.count_nonzero(numpy.abs(delta) > epsilon) <= 3 * density * n:
+        indices = __Moved(delta, epsilon)
+        if len(indices) <= density * n:
+            return SparseDelta(n, indices, delta[indices])
+    if epsilon > 0.0:
+        # Vertices that don't move by more than epsilon don't move at all
+        indices = __Moved(delta, epsilon)
+        zeroed = numpy.zeros_like(delta)
+        zeroed[indices] = delta[indices]
+        return zeroed
+    return delta
+
+def IsSparse(delta):
+    return isinstance(delta, SparseDelta)
+
+def ToDense(delta):
+    # Purpose: an (n, 3) float32 array of a dense or sparse delta
+    if isinstance(delta, SparseDelta):
+        return delta.ToDense()
+    return numpy.asarray(delta, dtype = numpy.float32)
+
+def VertexCount(delta):
+    # Purpose: n of a dense or sparse delta
+    return delta.n if isinstance(delta, SparseDelta) else len(delta)
+
+def __Scratch(n):
+    # A zeroed (n, 3) accumulator and a cleared vertex mask, per thread.
+    # Whoever uses them zeroes what they touched before returning.
+    scratch = getattr(__scratch, 'buffers', None)
+    if scratch is None or len(scratch[1]) != n:
+        scratch = __scratch.buffers = (numpy.zeros((n, 3), dtype = numpy.float32),
+                                       numpy.zeros(n, dtype = bool))
+    return scratch
+
+def __Accumulate(n, first, others, density):
+    # Purpose: first plus sign * delta of others [(delta, sign)], added up in order
+    # A sum with a dense term is dense. A sum of sparse terms is scattered into the
+    # scratch accumulator, so there are no index merges, and comes out dense if it
+    # moves more than density * n vertices.
+    for delta in [first] + [delta for delta, sign in others]:
+        if VertexCount(delta) != n:
+            raise ValueError('Deltas of different meshes (%i and %i vertices)' % (n, VertexCount(delta)))
+
+    if not isinstance(first, SparseDelta) or any(not isinstance(delta, SparseDelta) for delta, sign in others):
+        if isinstance(first, SparseDelta):
+            out = first.ToDense()
+        elif others and not isinstance(others[0][0], SparseDelta):
+            # dense + dense in one pass
+            delta, sign = others[0]
+            out = first + delta if sign > 0 else first - delta
+            others = others[1:]
+        else:
+            out = numpy.array(first, dtype = numpy.float32)
+        for delta, sign in others:
+            if isinstance(delta, SparseDelta):
+                # Indices are unique, so fancy += adds every offset
+                if sign > 0:
+                    out[delta.indices] += delta.offsets
+                else:
+                    out[delta.indices] -= delta.offsets
+            elif sign > 0:
+                out += delta
+            else:
+                out -= delta
+        return out
+
+    acc, mark = __Scratch(n)
+    acc[first.indices] = first.offsets
+    mark[first.indices] = True
+    for delta, sign in others:
+        if sign > 0:
+            acc[delta.indices] += delta.offsets
+        else:
+            acc[delta.indices] -= delta.offsets
+        mark[delta.indices] = True
+    indices = numpy.flatnonzero(mark).astype(numpy.int32)
+    if len(indices) > density * n:
+        out = acc.copy()
+    else:
+        out = SparseDelta(n, indices, acc[indices])
+    acc[indices] = 0.0
+    mark[indices] = False
+    return out
+
+def Add(a, b, density = SPARSE_DENSITY):
+    # Purpose: a + b of dense or sparse deltas, see __Accumulate for which comes out
+    return __Accumulate(VertexCount(a), a, [(b, 1)], density)
+
+def Subtract(a, b, density = SPARSE_DENSITY):
+    return __Accumulate(VertexCount(a), a, [(b, -1)], density)
+
+def SubtractAll(delta, others, density = SPARSE_DENSITY):
+    # Purpose: delta minus every one of others in turn, None in others stands for zero
+    return __Accumulate(VertexCount(delta), delta, [(o, -1) for o in others if o is not None], density)
+
+def Merge(deltas, n, density = SPARSE_DENSITY):
+    # Purpose: sums many deltas at once, None stands for zero
+    deltas = [d for d in deltas if d is not None]
+    if not deltas:
+        return Empty(n)
+    if len(deltas) == 1:
+        return deltas[0]
+    return __Accumulate(n, deltas[0], [(d, 1) for d in deltas[1:]], density)
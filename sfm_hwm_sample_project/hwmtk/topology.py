@@ -0,0 +1,121 @@
+# Purpose: mesh connectivity as flat arrays
+# Vertex adjacency is kept in CSR form: the neighbours of vertex i are
+# neighbours[offsets[i]:offsets[i + 1]], with the matching edge lengths in lengths.
+
+import hashlib
+
+import numpy
+
+import profiling
+
+# mesh name = MeshTopology
+__topologyCache = dict()
+
+
+class MeshTopology(object):
+    ''' n - vertex count
+        positions - (n, 3) float32 vertex positions
+        edges - (m, 2) int32 vertex index pairs
+        offsets, neighbours, lengths - the CSR adjacency '''
+    def __init__(self, positions, edges):
+        self.positions = numpy.asarray(positions, dtype = numpy.float32)
+        self.edges = numpy.asarray(edges, dtype = numpy.int32).reshape(-1, 2)
+        self.n = len(self.positions)
+
+        # Both directions of every edge, grouped by source vertex
+        src = numpy.concatenate((self.edges[:, 0], self.edges[:, 1]))
+        dst = numpy.concatenate((self.edges[:, 1], self.edges[:, 0]))
+        order = numpy.argsort(src, kind = 'stable')
+        src = src[order]
+        self.neighbours = dst[order]
+        self.offsets = numpy.zeros(self.n + 1, dtype = numpy.int32)
+        numpy.cumsum(numpy.bincount(src, minlength = self.n), out = self.offsets[1:])
+        self.lengths = numpy.linalg.norm(self.positions[self.neighbours] - self.positions[src],
+                                         axis = 1).astype(numpy.float32)
+        self.hash = TopologyHash(self.n, self.edges)
+        self.__lists = None
+        self.__kdtree = None
+
+    def Degrees(self):
+        return numpy.diff(self.offsets)
+
+    def Neighbours(self, index):
+        return self.neighbours[self.offsets[index]:self.offsets[index + 1]]
+
+    def Lists(self):
+        # Purpose: the CSR arrays as Python lists, for per-vertex loops that would
+        # otherwise pay for NumPy scalar indexing on every step
+        if self.__lists is None:
+            self.__lists = (self.offsets.tolist(), self.neighbours.tolist(), self.lengths.tolist())
+        return self.__lists
+
+    def KDTree(self):
+        # Purpose: a mathutils KD-tree over the positions, built on first use
+        # Returns None outside Blender
+        if self.__kdtree is None:
+            try:
+                from mathutils.kdtree import KDTree
+            except ImportError:
+                return None
+            tree = KDTree(self.n)
+            for i, co in enumerate(self.positions.tolist()):
+                tree.insert(co, i)
+            tree.balance()
+            self.__kdtree = tree
+        return self.__kdtree
+
+
+def FromBMesh(bmesh_in):
+    # Purpose: the topology of a bmesh, positions are the bmesh's vertex coordinates
+    if hasattr(bmesh_in.verts, "ensure_lookup_table"):
+        bmesh_in.verts.ensure_lookup_table()
+    positions = numpy.array([v.co[:] for v in bmesh_in.verts], dtype = numpy.float32).reshape(-1, 3)
+    edges = numpy.array([(e.verts[0].index, e.verts[1].index) for e in bmesh_in.edges],
+                        dtype = numpy.int32)
+    return MeshTopology(positions, edges)
+
+def TopologyHash(n, edges):
+    # Purpose: identifies a connectivity, changes whenever vertices or edges do
+    h = hashlib.sha1(str(n).encode())
+    h.update(numpy.ascontiguousarray(edges, dtype = numpy.int32).tobytes())
+    return h.hexdigest()
+
+def __ReadEdges(obj):
+    edges = numpy.zeros(len(obj.data.edges) * 2, dtype = numpy.int32)
+    obj.data.edges.foreach_get('vertices', edges)
+    return edges.reshape(-1, 2)
+
+@profiling.Profiled('TopologyFromMesh')
+def FromMesh(obj):
+    # Purpose: the topology of a mesh object at rest, read in bulk
+    data = obj.data
+    positions = numpy.zeros(len(data.vertices) * 3, dtype = numpy.float32)
+    data.vertices.foreach_get('co', positions)
+    return MeshTopology(positions.reshape(-1, 3), __ReadEdges(obj))
+
+def GetTopology(obj, validate = False):
+    # Purpose: the cached topology of a mesh object, built on first use
+    # The cache is trusted as long as vertex and edge counts match,
+    # validate = True also re-hashes the edges and rebuilds if they changed
+    topo = __topologyCache.get(obj.name)
+    if topo and topo.n == len(obj.data.vertices) and len(topo.edges) == len(obj.data.edges):
+        if not validate or topo.hash == TopologyHash(topo.n, __ReadEdges(obj)):
+            return topo
+    topo = FromMesh(obj)
+    __topologyCache[obj.name] = topo
+    return topo
+
+def InvalidateTopology(obj = None):
+    # Purpose: forgets the cached topology of obj, or of every mesh if None
+    if obj is None:
+        __topologyCache.clear()
+    else:
+        __topologyCache.pop(obj.name, None)
+
+def AsTopology(mesh_in):
+    # Purpose: accepts a MeshTopology, a bmesh or a mesh object (cached)
+    if isinstance(mesh_in, MeshTopology):
+        return mesh_in
+    if hasattr(mesh_in, 'verts'):
+        return FromBMesh(mesh_in)
+    return GetTopology(mesh_in)
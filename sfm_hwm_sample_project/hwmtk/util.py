@@ -1,15 +1,22 @@
-import bpy
+try:
+    import bpy
+except ImportError:
+    # Plain Python, see hwmcore
+    bpy = None
 
 import time
 
 # I only hope for more
 
+def DebugLevel():
+    return int(bpy.app.debug_value) if bpy else 0
+
 def DebugPrint(msg, level = 1):
-    if (level <= int(bpy.app.debug_value)):
+    if (level <= DebugLevel()):
         print (msg)
         
 def IsDebugging():
-    return bpy.app.debug_value > 0
+    return DebugLevel() > 0
 
 def GetMillisecs():
     return int(round(time.time() * 1000))